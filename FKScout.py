@@ -1,17 +1,22 @@
 import subprocess
 import logging
-from google.cloud import bigquery
-import pandas as pd
-from symbolic_analysis import find_pk, find_fk
-from validate_keys import check_pk_uniqueness, key_existence_check, verify_foreign_key
-import json
-from domain_model_diagram import generate_mermaid_programmatically, print_mermaid
-import sys
+from metrics import METRICS_PATH, OPENMETRICS_PATH, metrics
 from pathlib import Path
 import argparse
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+# subcommand -> the stages it runs, in pipeline order; every other stage is loaded from the last saved results
+COMMANDS = {
+    "extract": ["schema"],
+    "infer": ["pk_analysis", "fk_analysis"],
+    "validate": ["pk_validation", "composite_keys", "schema_validation"],
+    "render": ["relationships", "render"],
+}
+COMMANDS["run"] = [stage for stages in COMMANDS.values() for stage in stages]
+# stages that query the warehouse; the others only need saved results, and GPT-4
+WAREHOUSE_STAGES = {"schema", "pk_validation", "composite_keys", "schema_validation"}
+
 def authenticate_with_gcloud():
     """
     Ensure the user is authenticated via gcloud. Automatically open the browser if needed.
@@ -35,92 +40,77 @@ def authenticate_with_gcloud():
             print("Please run `gcloud auth application-default login` manually.")
             raise  # Re-raise the error to indicate failure.
 
-def list_datasets(client):
-    # list all datasets
-    datasets = client.list_datasets()
-
-    if not datasets:
-        print(f"No datasets found in project.")
-        return []
-
-    dataset_names = [dataset.dataset_id for dataset in datasets]
-    return dataset_names
-
-def extract_schema(client, project_id, dataset_id):
-    # query to fetch table schema
-    query = f"""
-    SELECT
-        table_name, 
-        column_name
-    FROM 
-        `{project_id}.{dataset_id}.INFORMATION_SCHEMA.COLUMNS`
-    ORDER BY 
-        table_name, ordinal_position
-    """
-
-    # execute the query
-    query_job = client.query(query)
-    results = query_job.to_dataframe()
-
-    return results
-
-def validate_keys(client, project_id, dataset, candidates):
-    candidates['records'] = None
-    candidates['unique_records'] = None
-    candidates['exists'] = None
-    candidates['valid_references'] = None
-    candidates['invalid_references'] = None
-
-    for index, row in candidates.iterrows():
-        try:
-            res = check_pk_uniqueness(client, project_id, dataset, row['table_name'], row['column_name'])
-            if res:
-                candidates.loc[index, 'records'] = res[0]
-                candidates.loc[index, 'unique_records'] = res[1]
-                print(res)
-            else:
-                print("Error")
-        except Exception as e:
-            print(f"Error: {e}")
-
-        try:
-            table_name = row['table_name'] if row['key_type'] == 'primary' else row['referenced_table']
-            column_name = row['column_name'] if row['key_type'] == 'primary' else row['referenced_column']
-            res = key_existence_check(client, project_id, dataset, table_name, column_name)
-            if res:
-                candidates.at[index, 'exists'] = res
-                print(res)
-            else:
-                print("Error")
-        except Exception as e:
-            print(f"Error: {e}")
-
-        try:
-            if row['key_type'] == 'foreign':
-                res = verify_foreign_key(client, project_id, dataset, row['table_name'], row['column_name'], row['referenced_table'], row['referenced_column'])
-                if res:
-                    candidates.at[index, 'valid_references'] = res[0]
-                    candidates.at[index, 'invalid_references'] = res[1]
-                    print(res)
-                else:
-                    print("Error")
-            else:
-                print('Skip')
-        except Exception as e:
-            print(f"Error: {e}")
-        if index in candidates.index:
-            print(candidates.loc[index])
-        else:
-            print(f"Index {index} no longer exists in the DataFrame.")
-    return candidates
-
-def main():
+def build_parser():
     parser = argparse.ArgumentParser(description="Process some variables.")
-    parser.add_argument("--project_id", required=True, help="Google Cloud Project ID")
-    parser.add_argument("--dataset", required=True, help="Dataset Name")
+    parser.add_argument("command", nargs="?", choices=list(COMMANDS),
+                        help="Run these stages without prompts: extract the schema, infer keys with GPT-4, validate "
+                             "them, render the diagram, or run them all")
+    parser.add_argument("--project_id", required=False, help="Google Cloud Project ID (required with the BigQuery backend)")
+    parser.add_argument("--dataset", required=False, help="Dataset Name (optional, maps every dataset in --region when omitted)")
+    parser.add_argument("--region", default="us", help="BigQuery region to read project-wide schemas from")
     parser.add_argument("--billing_project_id", required=False, help="Billing project ID (optional)")
+    parser.add_argument("--backend", choices=["bigquery", "duckdb"], default="bigquery",
+                        help="Read the schema and validate keys in BigQuery, or with DuckDB over local exports in --data_dir")
+    parser.add_argument("--data_dir", help="Directory of <table>.parquet/.csv files or <table>/ part directories for --backend duckdb")
+    parser.add_argument("--max_concurrent_jobs", type=int, default=8, help="Maximum number of BigQuery validation jobs in flight")
+    parser.add_argument("--validation_mode", "--validation-mode", choices=["exact", "approx"], default="exact",
+                        help="exact counts, or sampled/HLL estimates with exact queries only for borderline keys")
+    parser.add_argument("--llm_cache", default="files/llm_cache.sqlite", help="SQLite file caching GPT-4 key inference results")
+    parser.add_argument("--llm_cache_ttl_days", type=float, default=30, help="Days before a cached GPT-4 result expires")
+    parser.add_argument("--llm_cache_max_entries", type=int, default=10000, help="Maximum number of cached GPT-4 results")
+    parser.add_argument("--llm_concurrency", type=int, default=8, help="Maximum number of GPT-4 requests in flight")
+    parser.add_argument("--llm_rpm", type=int, default=500, help="OpenAI requests-per-minute limit")
+    parser.add_argument("--llm_tpm", type=int, default=30000, help="OpenAI tokens-per-minute limit")
+    parser.add_argument("--pk_token_budget", type=int, default=3000, help="Maximum schema tokens per primary key inference prompt")
+    parser.add_argument("--no_heuristics", dest="heuristics", action="store_false",
+                        help="Send every column to GPT-4 instead of resolving conventionally named keys locally")
+    parser.add_argument("--discover_from_data", action="store_true",
+                        help="Also find foreign keys by sketching column values and scoring their containment")
+    parser.add_argument("--composite_keys", action="store_true",
+                        help="Also search tables without a unique column for unique column combinations")
+    parser.add_argument("--max_key_columns", type=int, default=3, help="Widest composite key searched for")
+    parser.add_argument("--sample_percent", type=float, default=10, help="Child table sample size in approx validation mode")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Fetch the schema and re-analyze only tables that changed since the last run, without prompts")
+    parser.add_argument("--stages", help=f"Comma-separated stages to run without prompts: {', '.join(COMMANDS['run'])}")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the last run, skipping its completed stages and checkpointed validations")
+    parser.add_argument("--max_bytes", type=int,
+                        help="Byte budget for validation queries: dry-run them, skip what does not fit and cap bytes billed")
+    parser.add_argument("--diagram_partition", choices=["none", "component", "dataset"], default="none",
+                        help="Render one diagram per connected component or per dataset, for schemas too large for one")
+    parser.add_argument("--max_parallel_stages", type=int, default=2, help="Maximum number of independent stages run at once")
+    parser.add_argument("--no_job_stats", dest="job_stats", action="store_false",
+                        help="Answer short queries in one round-trip with query_and_wait, without recording cache hits")
+    return parser
+
+def main():
+    parser = build_parser()
     args = parser.parse_args()
-    
+    if args.backend == "duckdb":
+        if not args.data_dir:
+            parser.error("--backend duckdb needs --data_dir")
+        if args.incremental or args.discover_from_data:
+            parser.error("--incremental and --discover_from_data need the BigQuery backend")
+        if args.max_bytes:
+            # local files are not billed, and only BigQuery can dry-run a query
+            parser.error("--max_bytes needs the BigQuery backend")
+        args.project_id = args.project_id or "local"
+    elif not args.project_id:
+        parser.error("--project_id is required with the BigQuery backend")
+    if args.command and args.stages:
+        parser.error("choose either a command or --stages")
+
+    metrics.job_stats = args.job_stats
+
+    # the pipeline modules load pandas and pyarrow, so they are imported only once the arguments are valid
+    with metrics.timer("import", "pipeline"):
+        from bigquery_client import get_client
+        from pipeline import dependent_stages, load_run_state, run_pipeline
+        from schema_diff import save_snapshot
+        from stages import STAGES, build_context
+        from warehouse import BigQueryWarehouse, DuckDBWarehouse, SavedResultsWarehouse
+
     print(f"Project ID: {args.project_id}")
     print(f"Dataset Name: {args.dataset}")
     project_id = args.project_id
@@ -132,93 +122,65 @@ def main():
     else:
         print(f"Billing project id: {args.billing_project_id}")
         billing_project_id = project_id
-    
-
-    try:
-        authenticate_with_gcloud()
-    except RuntimeError as e:
-        print(e)
-
-    client = bigquery.Client(project=billing_project_id)
-    datasets = [dataset] if dataset else list_datasets(client)
-
-    print(f"- {dataset}")
-    user_input = input("Do you want to fetch a fresh database schema from BigQuery (yes/no)?")
-    if user_input == 'yes':
-        print("Fetching dataset schemas...")
-        schema_df = pd.DataFrame()
-        for dataset in datasets:
-            schema_df = pd.concat([schema_df, extract_schema(client, project_id, dataset)], ignore_index=True)
-
-        schema_df.to_csv("files/schema.csv", index=False)
-        print("Schema saved to files/schema.csv")
-    else:
-        schema_df = pd.read_csv("files/schema.csv")
-        print("Schema loaded from files/schema.csv")
-
-    user_input = input("Do you want to search for primary keys with GPT-4 (yes/no)?")
-    if user_input == 'yes':
-        print('Searching for primary keys')
-        pk_analysis_output = find_pk(schema_df)
-        primary_keys = pd.DataFrame(pk_analysis_output["arguments"]["keys"])
-        primary_keys.to_csv("files/pk_analysis.csv", index=False)
-        print('Primary key analysis saved to files/pk_analysis.txt')
-    else:
-        primary_keys = pd.read_csv("files/pk_analysis.csv")
-
-    user_input = input("Do you want to search for foreign keys with GPT-4 (yes/no)?")
-    if user_input == 'yes':
-        print('Searching for foreign keys')
-        candidates = pd.DataFrame()
-        for table in list(set(schema_df['table_name'])):
-            print(table)
-            table_data = schema_df[schema_df['table_name'] == table][['table_name', 'column_name']]
-            fk_analysis_output = find_fk(table_data, primary_keys)
-            print(fk_analysis_output)
-            if fk_analysis_output is None:
-                continue
-            elif "arguments" in fk_analysis_output and "keys" in fk_analysis_output["arguments"]:
-                foreign_keys = pd.DataFrame(fk_analysis_output["arguments"]["keys"])
-                foreign_keys['table_name'] = table
-            else:
-                continue
-            candidates = pd.concat([candidates, foreign_keys], ignore_index=True)
-        candidates = candidates[candidates['column_name']!="id"]
-        candidates.to_csv("files/fk_analysis.csv", index=False)
-    else:
-        candidates = pd.read_csv("files/fk_analysis.csv")
-
 
-    user_input = input("Do you want to run foreign and primary key validation (yes/no)?")
-    if user_input == 'yes':
-        print("Validating the keys")
-        filtered_candidates = candidates[
-            candidates['referenced_table'].notnull() & 
-            candidates['referenced_column'].notnull()
-        ].copy()
-        schema_validation = validate_keys(client, project_id, dataset, filtered_candidates)
-        print("Saving results as schema_validation.csv")
-        schema_validation.to_csv("files/schema_validation.csv", index=False)
+    if args.command:
+        selected = list(COMMANDS[args.command])
+    elif args.stages:
+        selected = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+        unknown = [stage for stage in selected if stage not in STAGES]
+        if unknown:
+            parser.error(f"unknown stages: {', '.join(unknown)}")
+    elif args.resume:
+        state = load_run_state()
+        selected = state["stages"] if state else list(STAGES)
+    elif args.incremental:
+        selected = list(STAGES)
     else:
-        schema_validation = pd.read_csv("files/schema_validation.csv")
-
-
-    filtered_schema = schema_validation[(
-        (schema_validation['exists']==1) & 
-        (schema_validation['valid_references']/(schema_validation['invalid_references']+schema_validation['valid_references'])>0.1)
-    )]
-    mermaid = generate_mermaid_programmatically(filtered_schema)
-    mermaid_html = print_mermaid(mermaid)
-    if mermaid_html:
-        # Save to a file
-        file = f'files/{dataset}_mermaid_chart.html'
-        with open(f"files/{dataset}_mermaid_chart.html", "w") as file:
-            file.write(mermaid_html)
-        print(f"Mermaid chart saved to 'files/{dataset}_chart.html'.")
+        # each yes runs a stage, every other stage is loaded from the last saved results
+        selected = ["relationships", "render"]
+        print(f"- {dataset or project_id}")
+        if input("Do you want to fetch a fresh database schema from BigQuery (yes/no)?") == 'yes':
+            selected.append("schema")
+        if input("Do you want to search for primary keys with GPT-4 (yes/no)?") == 'yes':
+            selected.append("pk_analysis")
+        if input("Do you want to search for foreign keys with GPT-4 (yes/no)?") == 'yes':
+            selected.append("fk_analysis")
+        if input("Do you want to run foreign and primary key validation (yes/no)?") == 'yes':
+            selected += ["pk_validation", "composite_keys", "schema_validation"]
+    if args.incremental and "schema" not in selected:
+        parser.error("--incremental needs the schema stage to detect changes")
+
+    if not WAREHOUSE_STAGES & set(selected) and not (args.discover_from_data and "fk_analysis" in selected):
+        # saved results are analyzed and rendered without credentials or a database
+        if args.backend == "duckdb":
+            dataset = dataset or DuckDBWarehouse.default_dataset(args.data_dir)
+        warehouse = SavedResultsWarehouse(project_id, dataset)
+    elif args.backend == "duckdb":
+        warehouse = DuckDBWarehouse.from_files(args.data_dir, dataset)
     else:
-        print("Failed to generate Mermaid chart.")
+        try:
+            authenticate_with_gcloud()
+        except RuntimeError as e:
+            print(e)
+        client = get_client(billing_project_id, max(32, args.max_concurrent_jobs * 2))
+        warehouse = BigQueryWarehouse(client, project_id, dataset, args.region)
+    context = build_context(args, warehouse)
+    try:
+        run_pipeline(STAGES, selected, context, args.resume, args.max_parallel_stages)
+    finally:
+        # written even when a stage fails, since that is when the timings matter most
+        metrics.print_summary()
+        metrics.write()
+        print(f"Metrics saved to '{METRICS_PATH}' and '{OPENMETRICS_PATH}'.")
+
+    if args.incremental and 'snapshot' in context:
+        # the changed tables only count as seen once every stage that reanalyzes them has run
+        skipped = dependent_stages(STAGES, "schema") - set(selected)
+        if skipped:
+            print(f"Schema snapshot not saved, the next --incremental run also needs: {', '.join(sorted(skipped))}")
+        else:
+            save_snapshot(context['snapshot'])
 
 
 if __name__ == "__main__":
     main()
-    
\ No newline at end of file
@@ -0,0 +1,132 @@
+import itertools
+import json
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+
+ARTIFACT_DIR = "files/artifacts"
+# versions kept of every artifact; older ones are deleted when a new one is saved
+ARTIFACT_VERSIONS_KEPT = 5
+
+# column types of the pipeline artifacts, so reloaded results keep nullable integer and float columns
+ARTIFACT_DTYPES = {
+    'table_name': 'string',
+    'column_name': 'string',
+    'data_type': 'string',
+    'is_nullable': 'string',
+    'key_type': 'string',
+    'referenced_table': 'string',
+    'referenced_column': 'string',
+    'inferred_by': 'string',
+    'records': 'Int64',
+    'unique_records': 'Int64',
+    'exists': 'Int64',
+    'valid_references': 'Float64',
+    'invalid_references': 'Float64',
+    'unique_records_margin': 'Float64',
+    'valid_ratio_lower': 'Float64',
+    'valid_ratio_upper': 'Float64',
+    'containment': 'Float64',
+    'containment_sample': 'Int64',
+    'uniqueness_ratio': 'Float64',
+    'valid_ratio': 'Float64',
+    'component': 'Int64',
+}
+
+def _manifest_path(name, store):
+    return os.path.join(store, name, "manifest.json")
+
+def read_manifest(name, store=ARTIFACT_DIR):
+    path = _manifest_path(name, store)
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return json.load(file)
+
+def latest_version(name, store=ARTIFACT_DIR):
+    manifest = read_manifest(name, store)
+    return manifest[-1]["version"] if manifest else None
+
+def apply_dtypes(df):
+    df = df.copy()
+    for column, dtype in ARTIFACT_DTYPES.items():
+        if column in df:
+            df[column] = df[column].astype(dtype)
+    return df
+
+def _write_artifact(name, schema, batches, inputs, store, keep=ARTIFACT_VERSIONS_KEPT):
+    directory = os.path.join(store, name)
+    os.makedirs(directory, exist_ok=True)
+    version = time.strftime("%Y%m%dT%H%M%S") + f"{time.time() % 1:.6f}"[1:]
+    path = os.path.join(directory, f"{version}.arrow")
+    rows = 0
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+
+    manifest = read_manifest(name, store)
+    manifest.append({
+        "version": version,
+        "file": os.path.basename(path),
+        "rows": rows,
+        "inputs": {input_name: latest_version(input_name, store) for input_name in inputs},
+    })
+    expired, manifest = manifest[:-keep], manifest[-keep:]
+    with open(_manifest_path(name, store), "w") as file:
+        json.dump(manifest, file, indent=2)
+    for entry in expired:
+        expired_path = os.path.join(directory, entry["file"])
+        if os.path.exists(expired_path):
+            os.remove(expired_path)
+    return version
+
+def save_artifact(name, df, inputs=(), store=ARTIFACT_DIR):
+    """
+    Write df as a new version of the named artifact in the Arrow IPC format.
+    The manifest records the current version of every input artifact it was built from.
+    """
+    table = pa.Table.from_pandas(apply_dtypes(df), preserve_index=False)
+    return _write_artifact(name, table.schema, table.to_batches(), inputs, store)
+
+def stream_artifact(name, batches, inputs=(), store=ARTIFACT_DIR):
+    """
+    Write Arrow record batches as a new version of the named artifact as they arrive, without collecting them first.
+    Returns None, and writes nothing, if there are no batches.
+    """
+    batches = iter(batches)
+    first = next(batches, None)
+    if first is None:
+        return None
+    return _write_artifact(name, first.schema, itertools.chain([first], batches), inputs, store)
+
+def open_artifact(name, version=None, store=ARTIFACT_DIR, columns=None):
+    """
+    Memory-map an artifact as an Arrow table, optionally only some of its columns. Nothing is copied until the
+    table is converted, and only the pages of the columns converted are read from disk.
+    Returns None if the artifact has never been saved.
+    """
+    manifest = read_manifest(name, store)
+    if not manifest:
+        return None
+    entry = manifest[-1] if version is None else next(e for e in manifest if e["version"] == version)
+    path = os.path.join(store, name, entry["file"])
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    if columns is not None:
+        table = table.select([column for column in columns if column in table.column_names])
+    return table
+
+def load_artifact(name, version=None, store=ARTIFACT_DIR, legacy_csv=None, columns=None):
+    """
+    Load an artifact, or only the given columns of it, as a DataFrame, falling back to the CSV written by earlier
+    FKScout versions. Returns None if neither exists.
+    """
+    table = open_artifact(name, version, store, columns)
+    if table is not None:
+        return table.to_pandas()
+    if legacy_csv and os.path.exists(legacy_csv):
+        usecols = None if columns is None else lambda column: column in columns
+        return apply_dtypes(pd.read_csv(legacy_csv, usecols=usecols))
+    return None
@@ -0,0 +1,295 @@
+"""
+Offline benchmark of the FKScout pipeline on synthetic star or snowflake schemas.
+
+BigQuery is replaced by the DuckDB warehouse backend and GPT-4 by a fake that answers with conventionally named keys
+after a simulated latency, so runs need neither a GCP project nor an OpenAI key. Every run is appended to
+files/benchmarks.jsonl and compared with the previous run of the same configuration.
+
+    python benchmark.py --tables 100 --rows 1000000 --shape snowflake
+    python benchmark.py --tables 1000 --rows 100000 -- --no_heuristics --validation_mode approx --llm_tpm 1000000
+
+Arguments after -- are passed to FKScout as they are. FKScout's OpenAI rate limits still apply to the fake, so raise
+--llm_rpm/--llm_tpm to measure the pipeline rather than the limiter.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+import duckdb
+import pandas as pd
+import FKScout
+import symbolic_analysis
+from metrics import metrics
+from pipeline import run_pipeline
+from stages import STAGES, build_context
+from warehouse import DuckDBWarehouse
+
+RESULTS_PATH = "files/benchmarks.jsonl"
+DATASET = "bench"
+# stages run by every benchmark; render is left out since it only writes HTML
+BENCHMARK_STAGES = [
+    "schema", "pk_analysis", "pk_validation", "fk_analysis", "composite_keys", "schema_validation", "relationships"
+]
+
+def generate_schema(con, tables=100, rows=100000, shape="star", references_per_fact=4, orphan_rate=0.01, seed=0):
+    """
+    Create a synthetic warehouse in the bench schema of a DuckDB database.
+
+    One table in ten is a fact table with `rows` rows and foreign keys to references_per_fact dimensions, the
+    rest are dimensions with rows / 100 rows. In a snowflake, each dimension also references a parent dimension.
+    Keys are named the conventional way (id, d0001_id), and orphan_rate of the foreign key values match nothing.
+    """
+    rng = random.Random(seed)
+    facts = max(1, tables // 10)
+    dimensions = [f"d{i:04d}" for i in range(max(1, tables - facts))]
+    dimension_rows = max(10, rows // 100)
+    con.execute(f"CREATE SCHEMA IF NOT EXISTS {DATASET}")
+
+    def reference(column, parent, salt):
+        # uniform over the parent keys, with orphan_rate of the values pointing past the last one
+        return (f"CASE WHEN hash(range, {salt}) % 10000 < {int(orphan_rate * 10000)} THEN {dimension_rows} + range "
+                f"ELSE hash(range, {salt + 1}) % {dimension_rows} END::BIGINT AS {column}")
+
+    for i, dimension in enumerate(dimensions):
+        columns = ["range AS id", "'name ' || range AS name", f"hash(range, {i}) % 5 AS category"]
+        if shape == "snowflake" and i > 0:
+            parent = dimensions[(i - 1) // 3]
+            columns.append(reference(f"{parent}_id", parent, 2 * i))
+        con.execute(f"CREATE OR REPLACE TABLE {DATASET}.{dimension} AS SELECT {', '.join(columns)} "
+                    f"FROM range({dimension_rows})")
+    for i in range(facts):
+        referenced = rng.sample(dimensions, min(references_per_fact, len(dimensions)))
+        columns = ["range AS id", "random() * 100 AS amount", "hash(range, 7) % 20 AS quantity"]
+        columns += [reference(f"{parent}_id", parent, 1000 + 2 * j) for j, parent in enumerate(referenced)]
+        con.execute(f"CREATE OR REPLACE TABLE {DATASET}.f{i:04d} AS SELECT {', '.join(columns)} FROM range({rows})")
+
+class FakeLLM:
+    """
+    Stands in for the OpenAI client: sleeps for a simulated latency, then proposes every id column as a primary
+    key and every <table>_id column as a foreign key, the way GPT-4 usually answers for conventional schemas.
+    """
+    def __init__(self, latency=1.0, jitter=0.3, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, functions, max_tokens=None, **kwargs):
+        prompt = messages[-1]["content"]
+        time.sleep(max(0.0, self.random.gauss(self.latency, self.jitter)))
+        if functions[0]["name"] == "validate_keys":
+            columns = self.read_csv(prompt)
+            keys = [
+                {"table_name": table, "column_name": column, "key_type": "primary"}
+                for table, column in zip(columns['table_name'], columns['column_name']) if column == "id"
+            ]
+        else:
+            table_csv, primary_keys_csv = prompt.split("as a reference:", 1)
+            columns = self.read_csv(table_csv)
+            tables = set(self.read_csv(primary_keys_csv).get('table_name', []))
+            keys = [
+                {"column_name": column, "key_type": "foreign", "referenced_table": column[:-3], "referenced_column": "id"}
+                for column in columns['column_name'] if column.endswith("_id") and column[:-3] in tables
+            ]
+        arguments = json.dumps({"keys": keys})
+        usage = SimpleNamespace(
+            prompt_tokens=symbolic_analysis.count_tokens(prompt),
+            completion_tokens=symbolic_analysis.count_tokens(arguments),
+        )
+        if kwargs.get("stream"):
+            return self.stream(functions[0]["name"], arguments, usage, max_tokens)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(
+                function_call=SimpleNamespace(name=functions[0]["name"], arguments=arguments)
+            ))],
+            usage=usage,
+        )
+
+    @staticmethod
+    def stream(name, arguments, usage, max_tokens=None, chunk_size=20):
+        # the answer in chunks of a few characters, cut off at max_tokens (about four characters each)
+        finish_reason = "function_call"
+        if max_tokens is not None and len(arguments) > max_tokens * 4:
+            arguments, finish_reason = arguments[:max_tokens * 4], "length"
+        for start in range(0, len(arguments), chunk_size):
+            function_call = SimpleNamespace(name=name if start == 0 else None, arguments=arguments[start:start + chunk_size])
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(delta=SimpleNamespace(function_call=function_call), finish_reason=None)],
+                usage=None,
+            )
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(function_call=None), finish_reason=finish_reason)], usage=None)
+        yield SimpleNamespace(choices=[], usage=usage)
+
+    @staticmethod
+    def read_csv(text):
+        # the prompts embed CSVs whose header starts with table_name or column_name
+        start = min((i for i in (text.find("table_name,"), text.find("column_name,")) if i >= 0), default=-1)
+        if start < 0:
+            return pd.DataFrame(columns=['table_name', 'column_name'])
+        lines = []
+        for line in text[start:].splitlines():
+            if not line.strip():
+                break
+            lines.append(line)
+        return pd.read_csv(io.StringIO("\n".join(lines)))
+
+def stage_counts(results):
+    """
+    The amount of work each stage did, used to turn its time into a throughput.
+    """
+    schema = results['schema']
+    validated = results['schema_validation']
+    table_rows = validated.drop_duplicates('table_name')['records'].astype(float).sum()
+    return {
+        "schema": (schema['table_name'].nunique(), "tables"),
+        "pk_analysis": (schema['table_name'].nunique(), "tables"),
+        "pk_validation": (len(results['pk_validation']), "candidates"),
+        "fk_analysis": (schema['table_name'].nunique(), "tables"),
+        "composite_keys": (schema['table_name'].nunique(), "tables"),
+        "schema_validation": (table_rows, "rows"),
+        "relationships": (len(validated), "candidates"),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def startup_seconds(*command):
+    """
+    Wall time of a fresh interpreter running command in the FKScout directory, so every import it needs is counted.
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *command], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True,
+                   check=True)
+    return time.perf_counter() - start
+
+def load_previous(config, path=RESULTS_PATH):
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as file:
+        for line in file:
+            entry = json.loads(line)
+            if entry["config"] == config:
+                previous = entry
+    return previous
+
+def report(entry, previous, tolerance):
+    """
+    Print the per-stage times and throughputs, flagging stages more than tolerance slower than the previous run.
+    Returns the names of the regressed stages.
+    """
+    regressions = []
+    print(f"{'stage':<18} {'seconds':>9} {'throughput':>22} {'previous':>9} {'change':>8}")
+    for stage, result in entry["stages"].items():
+        before = previous["stages"].get(stage) if previous else None
+        change = ""
+        if before and before["seconds"] > 0:
+            ratio = result["seconds"] / before["seconds"] - 1
+            change = f"{ratio:+.0%}"
+            if ratio > tolerance:
+                regressions.append(stage)
+                change += " !"
+        throughput = f"{result['throughput']:,.1f} {result['unit']}/s"
+        print(f"{stage:<18} {result['seconds']:>9.2f} {throughput:>22} "
+              f"{before['seconds'] if before else float('nan'):>9.2f} {change:>8}")
+    before = previous.get("startup", {}) if previous else {}
+    print("Startup: " + ", ".join(
+        f"{name} {seconds:.2f}s" + (f" (previous {before[name]:.2f}s)" if name in before else "")
+        for name, seconds in entry["startup"].items()
+    ))
+    print(f"LLM: {entry['llm_calls']} calls, {entry['llm_seconds']:.1f}s; "
+          f"queries: {entry['queries']}, {entry['query_seconds']:.1f}s")
+    if regressions:
+        print(f"Regressed by more than {tolerance:.0%}: {', '.join(regressions)}")
+    return regressions
+
+def run_benchmark(tables, rows, shape, llm_latency, llm_jitter, fkscout_args=(), database=None, seed=0):
+    """
+    Generate the schema, run the pipeline stages on it and return the timings as a results entry.
+    """
+    con = duckdb.connect(database or ":memory:")
+    start = time.perf_counter()
+    generate_schema(con, tables, rows, shape, seed=seed)
+    generation_seconds = time.perf_counter() - start
+
+    symbolic_analysis.client = FakeLLM(llm_latency, llm_jitter, seed)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # artifacts, checkpoints and the LLM cache of a benchmark never mix with those of real runs
+        os.chdir(workdir)
+        os.makedirs("files")
+        try:
+            args = FKScout.build_parser().parse_args([
+                "--backend", "duckdb", "--dataset", DATASET, "--stages", ",".join(BENCHMARK_STAGES), *fkscout_args
+            ])
+            context = build_context(args, DuckDBWarehouse(con, DATASET))
+            metrics.reset()
+            results = run_pipeline(STAGES, BENCHMARK_STAGES, context, max_parallel_stages=args.max_parallel_stages)
+        finally:
+            os.chdir(cwd)
+
+    summary = {(row["kind"], row["name"]): row for row in metrics.summary()}
+    counts = stage_counts(results)
+    stages = {}
+    for stage in BENCHMARK_STAGES:
+        seconds = summary.get(("stage", stage), {}).get("seconds", 0.0)
+        amount, unit = counts[stage]
+        stages[stage] = {"seconds": seconds, "throughput": amount / seconds if seconds else 0.0, "unit": unit}
+    llm = summary.get(("llm", "all"), {})
+    queries = summary.get(("bigquery", "all"), {})
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "generation_seconds": generation_seconds,
+        # the CLI alone, and with the pipeline modules every run that does work imports
+        "startup": {"help": startup_seconds("FKScout.py", "--help"), "pipeline": startup_seconds("-c", "import stages")},
+        "stages": stages,
+        "llm_calls": llm.get("calls", 0),
+        "llm_seconds": llm.get("seconds", 0.0),
+        "queries": queries.get("calls", 0),
+        "query_seconds": queries.get("seconds", 0.0),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FKScout on a synthetic schema without BigQuery or OpenAI.")
+    parser.add_argument("--tables", type=int, default=100, help="Number of tables (10 to several thousand)")
+    parser.add_argument("--rows", type=int, default=100000, help="Rows per fact table; dimensions get 1/100th")
+    parser.add_argument("--shape", choices=["star", "snowflake"], default="star", help="Dimension layout")
+    parser.add_argument("--llm_latency", type=float, default=1.0, help="Mean simulated GPT-4 latency in seconds")
+    parser.add_argument("--llm_jitter", type=float, default=0.3, help="Standard deviation of the simulated latency")
+    parser.add_argument("--database", help="DuckDB file to generate the data in (in memory by default)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated schema and latencies")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slowdown over the previous run reported as a regression")
+    parser.add_argument("--results", default=RESULTS_PATH, help="JSON lines file collecting every benchmark run")
+    parser.add_argument("fkscout_args", nargs=argparse.REMAINDER, help="FKScout arguments, after --")
+    args = parser.parse_args()
+    fkscout_args = [arg for arg in args.fkscout_args if arg != "--"]
+
+    config = {
+        "tables": args.tables, "rows": args.rows, "shape": args.shape, "llm_latency": args.llm_latency,
+        "seed": args.seed, "fkscout_args": fkscout_args,
+    }
+    print(f"Benchmarking {args.tables} tables ({args.shape}), {args.rows} rows per fact table")
+    entry = run_benchmark(args.tables, args.rows, args.shape, args.llm_latency, args.llm_jitter, fkscout_args,
+                          args.database, args.seed)
+    entry["config"] = config
+    print(f"Generated the data in {entry['generation_seconds']:.1f}s")
+    report(entry, load_previous(config, args.results), args.tolerance)
+
+    os.makedirs(os.path.dirname(args.results) or ".", exist_ok=True)
+    with open(args.results, "a") as file:
+        file.write(json.dumps(entry) + "\n")
+    print(f"Results appended to '{args.results}'.")
+
+if __name__ == "__main__":
+    main()
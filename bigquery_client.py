@@ -0,0 +1,52 @@
+import functools
+import time
+from metrics import metrics
+
+@functools.lru_cache(maxsize=None)
+def get_client(project, pool_size=32):
+    """
+    One shared client per project, with an HTTP connection pool large enough for every concurrent job.
+    The default pool keeps 10 connections, so busier schedulers reconnect (and redo TLS) on most requests.
+    The SDK is imported here rather than with the module, so runs that never reach BigQuery do not load it.
+    """
+    with metrics.timer("import", "google-cloud-bigquery"):
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+        from google.cloud import bigquery
+        from requests.adapters import HTTPAdapter
+    credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    return bigquery.Client(project=project, credentials=credentials, _http=session)
+
+def run_query(client, query, job_config=None):
+    if hasattr(job_config, "reserve"):
+        # a cost_planner.ByteBudget charges the query and caps it at its own estimate
+        job_config = job_config.reserve(query)
+    start = time.perf_counter()
+    # query_and_wait lets BigQuery answer short queries in one round-trip without polling a job, but its rows do
+    # not say whether the query cache answered; only a job does, so queries run as jobs while job stats are wanted
+    if hasattr(client, "query_and_wait") and not metrics.job_stats:
+        rows = client.query_and_wait(query, job_config=job_config)
+    else:
+        job = client.query(query, job_config=job_config)
+        rows = job.result()
+        # the row iterator of a job result has no cache flag of its own
+        rows.cache_hit = getattr(job, "cache_hit", False)
+    metrics.record_query(rows, time.perf_counter() - start)
+    return rows
+
+def fetch_row(client, query, job_config=None):
+    """
+    Run a query that returns a single row of aggregates and read it straight off the row iterator.
+    """
+    return next(iter(run_query(client, query, job_config)))
+
+def fetch_dataframe(client, query, job_config=None):
+    """
+    Run a query with a bulk result and convert it to pandas through Arrow.
+    """
+    rows = run_query(client, query, job_config)
+    with metrics.timer("pandas", "to_pandas"):
+        return rows.to_arrow(create_bqstorage_client=False).to_pandas()
@@ -0,0 +1,105 @@
+import math
+from itertools import combinations
+import pandas as pd
+from heuristics import key_stem, type_family
+from job_scheduler import run_jobs
+from schema_catalog import KEY_SEPARATOR
+
+# widest composite key searched for, and the most columns of a table it can be built from
+MAX_KEY_COLUMNS = 3
+MAX_CANDIDATE_COLUMNS = 8
+
+def candidate_columns(table_df, max_columns=MAX_CANDIDATE_COLUMNS):
+    """
+    The columns of one table that can be part of a key: joinable types only, key-like names first.
+    """
+    data_types = table_df['data_type'] if 'data_type' in table_df else [None] * len(table_df)
+    columns = [
+        column for column, data_type in zip(table_df['column_name'], data_types)
+        if type_family(data_type) is not None
+    ]
+    columns.sort(key=lambda column: key_stem(column) is None)
+    return columns[:max_columns]
+
+def is_unique(counts):
+    # (total_rows, unique_rows), plus the margin of error of approximate counts
+    total, unique = counts[0], counts[1]
+    margin = counts[2] if len(counts) == 3 else 0
+    return total > 0 and unique >= total - margin
+
+def lattice_level(columns, size, unique_keys, distinct, total):
+    """
+    The combinations of size columns worth counting. Supersets of a combination already found unique are
+    unique too, and columns whose distinct values multiply to fewer than total rows cannot be unique together.
+    """
+    level = []
+    for combination in combinations(columns, size):
+        if any(key <= set(combination) for key in unique_keys):
+            continue
+        if math.prod(distinct[column] for column in combination) < total:
+            continue
+        level.append(combination)
+    return level
+
+def find_composite_keys(warehouse, schema_df, tables, max_concurrent_jobs=8, max_key_columns=MAX_KEY_COLUMNS,
+                        approx=False, job_config=None):
+    """
+    Search the tables for their smallest unique column combinations, one lattice level at a time with one
+    query per table and level. The first level counts the distinct values of each candidate column, and a
+    table that already has a unique column is not searched further.
+    Returns the composite primary keys found, with their counts, in the layout of validate_keys.
+    """
+    columns = {
+        table: candidate_columns(table_df)
+        for table, table_df in schema_df[schema_df['table_name'].isin(tables)].groupby('table_name', sort=False)
+    }
+    columns = {table: table_columns for table, table_columns in columns.items() if len(table_columns) > 1}
+    print(f"Counting distinct values of {sum(map(len, columns.values()))} columns in {len(columns)} tables")
+    results = run_jobs([
+        (table, warehouse.check_uniqueness, (table, table_columns, approx, job_config))
+        for table, table_columns in columns.items()
+    ], max_concurrent_jobs)
+
+    searches = {}
+    for table, counts in results.items():
+        if isinstance(counts, Exception) or not counts or any(is_unique(count) for count in counts.values()):
+            continue
+        total = next(iter(counts.values()))[0]
+        if total:
+            # approximate counts can fall short of the true ones, so combinations are pruned on their upper bound
+            distinct = {column: (count[1] or 0) + (count[2] if len(count) == 3 else 0) for column, count in counts.items()}
+            searches[table] = (columns[table], distinct, total, [])
+
+    keys = []
+    for size in range(2, max_key_columns + 1):
+        levels = {
+            table: lattice_level(table_columns, size, unique_keys, distinct, total)
+            for table, (table_columns, distinct, total, unique_keys) in searches.items()
+        }
+        levels = {table: level for table, level in levels.items() if level}
+        if not levels:
+            break
+        print(f"Counting {sum(map(len, levels.values()))} {size}-column combinations in {len(levels)} tables")
+        results = run_jobs([
+            (table, warehouse.check_uniqueness, (table, [KEY_SEPARATOR.join(c) for c in level], approx, job_config))
+            for table, level in levels.items()
+        ], max_concurrent_jobs)
+        for table, counts in results.items():
+            if isinstance(counts, Exception):
+                continue
+            for combination in levels[table]:
+                column_name = KEY_SEPARATOR.join(combination)
+                count = counts.get(column_name)
+                if count and is_unique(count):
+                    searches[table][3].append(set(combination))
+                    keys.append({
+                        "table_name": table,
+                        "column_name": column_name,
+                        "key_type": "primary",
+                        "records": count[0],
+                        "unique_records": count[1],
+                        "exists": 1,
+                    })
+    return pd.DataFrame(
+        keys, columns=['table_name', 'column_name', 'key_type', 'records', 'unique_records', 'exists']
+    )
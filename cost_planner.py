@@ -0,0 +1,143 @@
+import re
+import threading
+import pandas as pd
+from job_scheduler import run_jobs
+from validate_keys import BIGQUERY, foreign_keys_batch_query, pk_uniqueness_batch_query
+
+# BigQuery on-demand price in USD, only used to put the byte counts in perspective
+ON_DEMAND_PRICE_PER_TIB = 6.25
+# BigQuery bills at least 10 MB for every table a query references
+MIN_BYTES_BILLED_PER_TABLE = 10 * 1024 ** 2
+# headroom over a query's dry-run estimate in its maximum_bytes_billed
+BUDGET_SLACK = 0.1
+
+def estimate_bytes(client, query):
+    from google.cloud import bigquery
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    return client.query(query, job_config=job_config).total_bytes_processed
+
+def format_bytes(num_bytes):
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if num_bytes < 1024 or unit == "TiB":
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+
+class BudgetExceeded(Exception):
+    pass
+
+class ByteBudget:
+    """
+    What is left of --max_bytes, shared by every query of a run.
+    Each query is dry-run and charged what it would bill before it runs, and capped at that plus BUDGET_SLACK, so
+    a run bills at most (1 + BUDGET_SLACK) * max_bytes. A query that no longer fits raises BudgetExceeded.
+    bigquery_client.run_query calls reserve when a ByteBudget is passed as the job config.
+    """
+    def __init__(self, client, max_bytes, slack=BUDGET_SLACK):
+        self.client = client
+        self.remaining = max_bytes
+        self.slack = slack
+        self.lock = threading.Lock()
+        self.estimates = {}
+        # queries charged by plan_validation ahead of running them
+        self.held = {}
+
+    def estimate(self, query):
+        """
+        The bytes the query would bill: its dry-run estimate, but at least the minimum for every table it reads.
+        """
+        if query not in self.estimates:
+            tables = len(set(re.findall(r"`[^`]+\.[^`]+\.[^`]+`", query))) or 1
+            self.estimates[query] = max(estimate_bytes(self.client, query) or 0, MIN_BYTES_BILLED_PER_TABLE * tables)
+        return self.estimates[query]
+
+    def hold(self, queries):
+        # charge planned queries up front, so queries planned later or run unplanned cannot take their share
+        with self.lock:
+            for query in queries:
+                self.remaining -= self.estimate(query)
+                self.held[query] = self.held.get(query, 0) + 1
+
+    def reserve(self, query):
+        """
+        Charge a query that is about to run and return the job config capping what it can bill.
+        """
+        estimate = self.estimate(query)
+        with self.lock:
+            if self.held.get(query):
+                self.held[query] -= 1
+            elif estimate > self.remaining:
+                raise BudgetExceeded(
+                    f"query would bill {format_bytes(estimate)}, {format_bytes(max(self.remaining, 0))} left of --max_bytes"
+                )
+            else:
+                self.remaining -= estimate
+        return budget_job_config(estimate * (1 + self.slack))
+
+def validation_queries(project_id, dataset, candidates, validation_mode="exact", sample_percent=10, dialect=BIGQUERY):
+    """
+    The batched queries validate_keys will run for the candidates, as {table_name: [query, ...]}.
+    """
+    approx = validation_mode == "approx"
+    queries = {}
+    for table, group in candidates.groupby('table_name', sort=False):
+        columns = list(dict.fromkeys(group['column_name']))
+        queries[table] = [pk_uniqueness_batch_query(project_id, dataset, table, columns, approx, dialect)]
+        foreign_keys = group[group['key_type'] == 'foreign']
+        if len(foreign_keys):
+            references = list(dict.fromkeys(zip(
+                foreign_keys['column_name'], foreign_keys['referenced_table'], foreign_keys['referenced_column']
+            )))
+            queries[table].append(foreign_keys_batch_query(
+                project_id, dataset, table, references, sample_percent if approx else None, dialect
+            ))
+    return queries
+
+def plan_validation(budget, project_id, dataset, candidates, catalog=None, validation_mode="exact",
+                    sample_percent=10, max_concurrent_jobs=8, dialect=BIGQUERY):
+    """
+    Dry-run every validation query and keep the cheapest tables that fit in what is left of the budget, whose
+    queries are charged to it right away.
+    Returns the candidates to validate, the candidates pruned to stay within budget, and the plan per table.
+    """
+    queryable = catalog.filter_existing(candidates) if catalog is not None else candidates
+    queries = validation_queries(project_id, dataset, queryable, validation_mode, sample_percent, dialect)
+    results = run_jobs([
+        ((table, i), budget.estimate, (query,))
+        for table, table_queries in queries.items()
+        for i, query in enumerate(table_queries)
+    ], max_concurrent_jobs)
+
+    plan = []
+    for table, table_queries in queries.items():
+        estimates = [results[(table, i)] for i in range(len(table_queries))]
+        # a query that fails the dry run will fail for real too, so it costs nothing
+        plan.append({
+            "table_name": table,
+            "bytes": sum(estimate or 0 for estimate in estimates if not isinstance(estimate, Exception)),
+        })
+    plan = pd.DataFrame(plan, columns=["table_name", "bytes"]).sort_values("bytes", kind="stable")
+    plan["cumulative_bytes"] = plan["bytes"].cumsum()
+    plan["within_budget"] = plan["cumulative_bytes"] <= budget.remaining
+    budget.hold([
+        query for table in plan.loc[plan["within_budget"], "table_name"]
+        for i, query in enumerate(queries[table]) if not isinstance(results[(table, i)], Exception)
+    ])
+
+    total = plan["bytes"].sum()
+    kept = plan.loc[plan["within_budget"], "bytes"].sum()
+    print(f"Validation would scan {format_bytes(total)} "
+          f"(~${total / 1024 ** 4 * ON_DEMAND_PRICE_PER_TIB:.2f} on demand); "
+          f"{format_bytes(kept)} across {int(plan['within_budget'].sum())} of {len(plan)} tables fits the budget")
+    for _, row in plan.iterrows():
+        status = "run" if row["within_budget"] else "skip"
+        print(f"  {status:4} {format_bytes(row['bytes']):>12}  {row['table_name']}")
+
+    within = candidates['table_name'].isin(plan.loc[plan["within_budget"], "table_name"])
+    # candidates that cannot be queried cost nothing and are still reported by validate_keys
+    within |= ~candidates['table_name'].isin(plan["table_name"])
+    return candidates[within], candidates[~within], plan
+
+def budget_job_config(max_bytes):
+    # BigQuery refuses to run any query that would bill more than this, instead of billing it
+    from google.cloud import bigquery
+    return bigquery.QueryJobConfig(maximum_bytes_billed=int(max_bytes))
@@ -1,8 +1,6 @@
+import re
 import pandas as pd
-from openai import OpenAI
-import os
-
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+from symbolic_analysis import get_client
 
 def create_domain_model_diagram_with_openai(schema):
 
@@ -25,7 +23,7 @@ def create_domain_model_diagram_with_openai(schema):
 
     try:
         # Send request to OpenAI API
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model="gpt-4",
             messages=messages,
             max_tokens=1000
@@ -39,17 +37,23 @@ def create_domain_model_diagram_with_openai(schema):
         print(f"Error: {e}")
         return None
 
-def generate_mermaid_programmatically(df):
-    diagram = "erDiagram\n"
+def entity_name(table):
+    # Mermaid entity names cannot contain dots, as in the dataset.table names of project-wide runs
+    return re.sub(r"[^\w-]", "_", str(table))
 
-    for _, row in df.iterrows():
-        if pd.notna(row['referenced_table']) and row['referenced_table'] != "":
-            diagram += row['table_name']
-            diagram += " }o--||"
-            diagram += row['referenced_table']
-            diagram += ' : "" '
-            diagram += "\n"
-    return diagram
+def generate_mermaid_programmatically(df):
+    """
+    Build an ER diagram with one edge per pair of related tables, labelled with the referencing columns.
+    Tables whose names Mermaid cannot use are declared under a safe name, labelled with the real one.
+    """
+    edges = df[df['referenced_table'].notna() & (df['referenced_table'] != "")]
+    edges = edges.groupby(['table_name', 'referenced_table'], sort=False)['column_name'] \
+        .agg(lambda columns: ", ".join(dict.fromkeys(columns))).reset_index()
+    tables = dict.fromkeys([*edges['table_name'], *edges['referenced_table']])
+    aliases = [f'{entity_name(table)}["{table}"]' for table in tables if entity_name(table) != table]
+    lines = (edges['table_name'].map(entity_name) + ' }o--|| ' + edges['referenced_table'].map(entity_name)
+             + ' : "' + edges['column_name'] + '"')
+    return "\n".join(["erDiagram", *aliases, *lines]) + "\n"
 
 def print_mermaid(diagram):
     diagram = f"""
@@ -0,0 +1,170 @@
+import re
+import pandas as pd
+from schema_catalog import key_columns
+
+# BigQuery and DuckDB types that can hold a key, grouped so that columns in the same group can be joined
+KEY_TYPE_FAMILIES = {
+    "INT64": "integer",
+    "INTEGER": "integer",
+    "NUMERIC": "integer",
+    "BIGNUMERIC": "integer",
+    "STRING": "string",
+    "BYTES": "bytes",
+    "TINYINT": "integer",
+    "SMALLINT": "integer",
+    "BIGINT": "integer",
+    "HUGEINT": "integer",
+    "UTINYINT": "integer",
+    "USMALLINT": "integer",
+    "UINTEGER": "integer",
+    "UBIGINT": "integer",
+    "DECIMAL": "integer",
+    "VARCHAR": "string",
+    "BLOB": "bytes",
+    "UUID": "uuid",
+}
+KEY_SUFFIX = re.compile(r"^(.*?)[_]?(id|key|code|ref|fk|no|number)$", re.IGNORECASE)
+CAMEL_ID = re.compile(r"^(.+?)(Id|ID|Key)$")
+
+def normalize(name):
+    return re.sub(r"[^a-z0-9]", "", str(name).lower())
+
+def base_name(table):
+    # strip the dataset from project-wide table names, e.g. sales.customers -> customers
+    return str(table).rsplit(".", 1)[-1]
+
+def dataset_of(table):
+    return str(table).rsplit(".", 1)[0] if "." in str(table) else None
+
+def singularize(name):
+    name = normalize(name)
+    if name.endswith("ies"):
+        return name[:-3] + "y"
+    if name.endswith(("sses", "xes", "ches", "shes")):
+        return name[:-2]
+    if name.endswith("s") and not name.endswith("ss"):
+        return name[:-1]
+    return name
+
+def key_stem(column):
+    """
+    The entity a key-like column name points at, e.g. customer_id, customerId and CustomerKey -> customer.
+    """
+    match = CAMEL_ID.match(str(column)) or KEY_SUFFIX.match(str(column))
+    if match and match.group(1):
+        return singularize(match.group(1))
+    return None
+
+def type_family(data_type):
+    if data_type is None or pd.isna(data_type):
+        return "unknown"
+    # parameterized types such as NUMERIC(10) or DECIMAL(18,0) belong to the family of their base type
+    return KEY_TYPE_FAMILIES.get(re.sub(r"\(.*\)$", "", str(data_type).upper()).strip())
+
+def types_compatible(left, right):
+    left, right = type_family(left), type_family(right)
+    return "unknown" in (left, right) or left == right
+
+def _data_types(schema_df):
+    if 'data_type' not in schema_df:
+        return {}
+    return dict(zip(zip(schema_df['table_name'], schema_df['column_name']), schema_df['data_type']))
+
+def infer_primary_keys(schema_df):
+    """
+    Resolve primary keys named id, <table>_id or <singular>Id without the LLM.
+    Returns the resolved keys and the schema rows of the tables that are left for find_pk.
+    """
+    keys = []
+    for table, table_df in schema_df.groupby('table_name', sort=False):
+        entity = singularize(base_name(table))
+        for column in table_df['column_name']:
+            if normalize(column) == "id" or key_stem(column) in (entity, normalize(base_name(table))):
+                keys.append({"table_name": table, "column_name": column, "key_type": "primary"})
+                break
+    primary_keys = pd.DataFrame(keys, columns=['table_name', 'column_name', 'key_type'])
+    unresolved = schema_df[~schema_df['table_name'].isin(primary_keys['table_name'])]
+    return primary_keys, unresolved
+
+def tables_named_by(schema_df, tables):
+    """
+    Tables with a key-like column whose name points at any of the given tables, e.g. orders.customer_id for customers.
+    """
+    entities = set()
+    for table in tables:
+        entities |= {singularize(base_name(table)), normalize(base_name(table))}
+    return {
+        table for table, column in zip(schema_df['table_name'], schema_df['column_name'])
+        if table not in tables and (key_stem(column) in entities or singularize(column) in entities)
+    }
+
+def infer_foreign_keys(schema_df, primary_keys):
+    """
+    Resolve foreign keys whose name points at exactly one table with a known, type-compatible primary key.
+    Returns the resolved keys and the schema rows of the ambiguous columns that are left for find_fk.
+    Only columns whose type cannot hold a key are dropped; those not resolved by name, such as created_by or
+    parent, are left for find_fk too.
+    """
+    data_types = _data_types(schema_df)
+    parents = {}
+    for _, key in primary_keys.iterrows():
+        parents.setdefault(key['table_name'], key['column_name'])
+    entities = {}
+    for table in parents:
+        for name in {singularize(base_name(table)), normalize(base_name(table))}:
+            entities.setdefault(name, []).append(table)
+
+    keys = []
+    ambiguous = []
+    for index, row in schema_df.iterrows():
+        table, column = row['table_name'], row['column_name']
+        if normalize(column) == "id" or parents.get(table) == column:
+            continue
+        if type_family(data_types.get((table, column))) is None:
+            continue
+        stem = key_stem(column)
+        matches = [
+            parent for parent in entities.get(stem, []) + entities.get(singularize(column), [])
+            if parent != table
+        ]
+        matches = list(dict.fromkeys(matches))
+        if len(matches) > 1:
+            # the same table name in several datasets: prefer the child's own dataset
+            matches = [parent for parent in matches if dataset_of(parent) == dataset_of(table)] or matches
+        if len(matches) == 1 and types_compatible(
+            data_types.get((table, column)), data_types.get((matches[0], parents[matches[0]]))
+        ):
+            keys.append({
+                "table_name": table,
+                "column_name": column,
+                "key_type": "foreign",
+                "referenced_table": matches[0],
+                "referenced_column": parents[matches[0]],
+            })
+        else:
+            ambiguous.append(index)
+    foreign_keys = pd.DataFrame(
+        keys, columns=['table_name', 'column_name', 'key_type', 'referenced_table', 'referenced_column']
+    )
+    return foreign_keys, schema_df.loc[ambiguous]
+
+def infer_composite_foreign_keys(schema_df, composite_keys):
+    """
+    Propose a foreign key wherever another table has every column of a composite primary key, under the same names.
+    """
+    table_columns = {table: set(group['column_name']) for table, group in schema_df.groupby('table_name', sort=False)}
+    keys = []
+    for parent, column_name in zip(composite_keys['table_name'], composite_keys['column_name']):
+        columns = set(key_columns(column_name))
+        for table, available in table_columns.items():
+            if table != parent and columns <= available:
+                keys.append({
+                    "table_name": table,
+                    "column_name": column_name,
+                    "key_type": "foreign",
+                    "referenced_table": parent,
+                    "referenced_column": column_name,
+                })
+    return pd.DataFrame(
+        keys, columns=['table_name', 'column_name', 'key_type', 'referenced_table', 'referenced_column']
+    )
@@ -0,0 +1,126 @@
+import pandas as pd
+from bigquery_client import fetch_row
+from heuristics import type_family, types_compatible
+from job_scheduler import run_jobs
+from validate_keys import table_ref
+
+# number of smallest value hashes kept per column (a bottom-k MinHash sketch)
+SKETCH_SIZE = 256
+
+def column_sketch_query(project_id, dataset, table, columns, sketch_size=SKETCH_SIZE):
+    # values are hashed as strings so INT64 and STRING keys holding the same ids still match
+    sketches = []
+    for i, column in enumerate(columns):
+        value_hash = f"FARM_FINGERPRINT(CAST(`{column}` AS STRING))"
+        sketches.append(
+            f"APPROX_COUNT_DISTINCT(`{column}`) AS distinct_{i},\n"
+            f"        ARRAY_AGG(DISTINCT {value_hash} IGNORE NULLS ORDER BY {value_hash} LIMIT {sketch_size}) AS sketch_{i}"
+        )
+    sketches = ",\n        ".join(sketches)
+    return f"""
+    SELECT
+        COUNT(*) AS total_rows,
+        {sketches}
+    FROM {table_ref(project_id, dataset, table)};
+    """
+
+def compute_column_sketches(client, project_id, dataset, table, columns, sketch_size=SKETCH_SIZE, job_config=None):
+    """
+    Sketch every given column of one table in a single scan.
+    Returns a dict mapping each column to (total_rows, distinct_values, sorted list of the smallest value hashes).
+    """
+    query = column_sketch_query(project_id, dataset, table, columns, sketch_size)
+    row = fetch_row(client, query, job_config)
+    total_rows = row["total_rows"]
+    return {
+        column: (total_rows, row[f"distinct_{i}"], sorted(row[f"sketch_{i}"]))
+        for i, column in enumerate(columns)
+    }
+
+def estimate_containment(child, parent, sketch_size=SKETCH_SIZE):
+    """
+    Estimate the share of the child's distinct values that also occur in the parent.
+    A parent sketch holds every parent hash up to its largest entry, so the child hashes below that
+    bound are a uniform sample whose membership in the parent is known exactly.
+    Returns (containment, sample_size).
+    """
+    child_hashes, parent_hashes = child[2], parent[2]
+    if len(parent_hashes) < sketch_size:
+        bound = float("inf")
+    else:
+        bound = parent_hashes[-1]
+    sample = [value for value in child_hashes if value <= bound]
+    if not sample:
+        return 0.0, 0
+    parent_set = set(parent_hashes)
+    return sum(value in parent_set for value in sample) / len(sample), len(sample)
+
+def discover_inclusion_dependencies(client, project_id, dataset, schema_df, max_concurrent_jobs=8,
+                                    min_containment=0.9, min_uniqueness=0.95, min_sample=5, sketch_size=SKETCH_SIZE,
+                                    child_tables=None, job_config=None):
+    """
+    Find foreign key candidates from the data: a child column whose values are (almost) all contained
+    in a unique parent column. Needs one sketch query per table instead of one join per column pair.
+    Every table in schema_df can be a parent; with child_tables, only the columns of those tables are scored as children.
+    Pairs where fewer than min_sample child hashes fall inside the parent sketch are too uncertain to score;
+    this mostly skips children with far fewer distinct values than their parent.
+    """
+    key_columns = schema_df
+    if 'data_type' in schema_df:
+        key_columns = schema_df[[type_family(data_type) is not None for data_type in schema_df['data_type']]]
+    data_types = {}
+    if 'data_type' in key_columns:
+        data_types = dict(zip(zip(key_columns['table_name'], key_columns['column_name']), key_columns['data_type']))
+    columns_by_table = {
+        table: list(dict.fromkeys(group['column_name']))
+        for table, group in key_columns.groupby('table_name', sort=False)
+    }
+
+    print(f"Sketching key-like columns of {len(columns_by_table)} tables")
+    results = run_jobs([
+        (table, compute_column_sketches, (client, project_id, dataset, table, columns, sketch_size, job_config))
+        for table, columns in columns_by_table.items()
+    ], max_concurrent_jobs)
+
+    sketches = {}
+    for table, table_sketches in results.items():
+        if isinstance(table_sketches, Exception):
+            continue
+        for column, sketch in table_sketches.items():
+            if sketch[1]:
+                sketches[(table, column)] = sketch
+    parents = {
+        key: sketch for key, sketch in sketches.items()
+        if sketch[0] and sketch[1] / sketch[0] >= min_uniqueness
+    }
+
+    keys = []
+    for (table, column), child in sketches.items():
+        if child_tables is not None and table not in child_tables:
+            continue
+        # single-valued and boolean-like columns are contained in almost anything
+        if child[1] < 2:
+            continue
+        for (parent_table, parent_column), parent in parents.items():
+            if (parent_table, parent_column) == (table, column):
+                continue
+            # a contained column cannot have more distinct values, give or take the HLL error
+            if child[1] > parent[1] * 1.05:
+                continue
+            if not types_compatible(data_types.get((table, column)), data_types.get((parent_table, parent_column))):
+                continue
+            containment, sample_size = estimate_containment(child, parent, sketch_size)
+            if sample_size >= min_sample and containment >= min_containment:
+                keys.append({
+                    "table_name": table,
+                    "column_name": column,
+                    "key_type": "foreign",
+                    "referenced_table": parent_table,
+                    "referenced_column": parent_column,
+                    "containment": containment,
+                    "containment_sample": sample_size,
+                })
+    return pd.DataFrame(keys, columns=[
+        'table_name', 'column_name', 'key_type', 'referenced_table', 'referenced_column',
+        'containment', 'containment_sample',
+    ])
@@ -0,0 +1,44 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# BigQuery reports quota and rate limits as 403s with one of these reasons
+RETRYABLE_REASONS = {"rateLimitExceeded", "quotaExceeded", "jobRateLimitExceeded", "backendError"}
+
+def is_retryable(error):
+    from google.api_core import exceptions
+    if isinstance(error, (exceptions.TooManyRequests, exceptions.ServiceUnavailable, exceptions.InternalServerError)):
+        return True
+    if isinstance(error, exceptions.Forbidden):
+        return any(e.get("reason") in RETRYABLE_REASONS for e in (error.errors or []))
+    return False
+
+def run_with_retry(func, *args, max_retries=5, backoff=1.0):
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args)
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = backoff * 2 ** attempt + random.uniform(0, backoff)
+            print(f"Rate limited, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+def run_jobs(jobs, max_concurrent_jobs=8, max_retries=5):
+    """
+    Run (key, func, args) jobs with at most max_concurrent_jobs queries in flight.
+    Returns a dict mapping each key to the job's result, or to the exception it raised.
+    """
+    with ThreadPoolExecutor(max_workers=max_concurrent_jobs) as executor:
+        futures = {
+            key: executor.submit(run_with_retry, func, *args, max_retries=max_retries)
+            for key, func, args in jobs
+        }
+    results = {}
+    for key, future in futures.items():
+        try:
+            results[key] = future.result()
+        except Exception as e:
+            print(f"Error in {key}: {e}")
+            results[key] = e
+    return results
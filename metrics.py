@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_PATH = "files/metrics.json"
+OPENMETRICS_PATH = "files/metrics.prom"
+
+class Metrics:
+    """
+    Thread-safe recorder of stage timings, BigQuery job stats and LLM usage for one run.
+    Every event is a dict with a kind ('stage', 'import', 'bigquery', 'llm' or 'pandas'), a name and its measurements.
+    """
+    def __init__(self, job_stats=True):
+        self.lock = threading.Lock()
+        # whether queries run as jobs, whose stats include cache hits
+        self.job_stats = job_stats
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+            self.started = time.time()
+
+    def record(self, kind, name, **values):
+        with self.lock:
+            self.events.append({"kind": kind, "name": name, **values})
+
+    @contextmanager
+    def timer(self, kind, name, **values):
+        start = time.perf_counter()
+        try:
+            yield values
+        finally:
+            self.record(kind, name, seconds=time.perf_counter() - start, **values)
+
+    def record_query(self, rows, seconds):
+        """
+        Record the stats BigQuery reports on a finished query; queued is the time between submission and start.
+        Rows without a cache_hit flag (from query_and_wait) record no cache hit either way.
+        """
+        created, started = getattr(rows, "created", None), getattr(rows, "started", None)
+        cache_hit = getattr(rows, "cache_hit", None)
+        self.record(
+            "bigquery", getattr(rows, "job_id", None) or "query",
+            seconds=seconds,
+            bytes_processed=getattr(rows, "total_bytes_processed", None) or 0,
+            slot_ms=getattr(rows, "slot_millis", None) or 0,
+            queued_seconds=(started - created).total_seconds() if created and started else 0.0,
+            **({} if cache_hit is None else {"cache_hit": bool(cache_hit)}),
+        )
+
+    def record_completion(self, name, response, seconds, **values):
+        usage = getattr(response, "usage", None)
+        self.record(
+            "llm", name,
+            seconds=seconds,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+            completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+            **values,
+        )
+
+    def summary(self):
+        """
+        Totals per kind and stage, as rows of {kind, name, calls, seconds, ...}.
+        Stages and imported modules are listed one by one, the other kinds are summed over all their calls.
+        """
+        with self.lock:
+            events = list(self.events)
+        rows = {}
+        for event in events:
+            key = (event["kind"], event["name"] if event["kind"] in ("stage", "import") else "all")
+            row = rows.setdefault(key, {"kind": key[0], "name": key[1], "calls": 0})
+            row["calls"] += 1
+            for field, value in event.items():
+                if field not in ("kind", "name") and isinstance(value, (int, float)):
+                    row[field] = row.get(field, 0) + value
+        return list(rows.values())
+
+    def print_summary(self):
+        print(f"{'kind':<9} {'name':<18} {'calls':>6} {'seconds':>9} {'GiB':>8} {'slot s':>8} "
+              f"{'cached':>6} {'queued s':>8} {'tokens in':>9} {'tokens out':>10}")
+        for row in self.summary():
+            print(f"{row['kind']:<9} {row['name']:<18} {row['calls']:>6} {row.get('seconds', 0):>9.2f} "
+                  f"{row.get('bytes_processed', 0) / 1024 ** 3:>8.2f} {row.get('slot_ms', 0) / 1000:>8.1f} "
+                  f"{row.get('cache_hit', 0):>6} {row.get('queued_seconds', 0):>8.2f} "
+                  f"{row.get('prompt_tokens', 0):>9} {row.get('completion_tokens', 0):>10}")
+        print(f"Total wall time: {time.time() - self.started:.2f}s")
+
+    def write(self, path=METRICS_PATH, openmetrics_path=OPENMETRICS_PATH):
+        """
+        Write every event and the summary as JSON, and the summary in the OpenMetrics text format.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        summary = self.summary()
+        with self.lock:
+            events = list(self.events)
+        with open(path, "w") as file:
+            json.dump({"started": self.started, "events": events, "summary": summary}, file, indent=2)
+
+        lines = []
+        for field in ["calls", "seconds", "bytes_processed", "slot_ms", "cache_hit", "queued_seconds",
+                      "prompt_tokens", "completion_tokens"]:
+            metric = f"fkscout_{field}"
+            lines.append(f"# TYPE {metric} counter")
+            for row in summary:
+                if field in row:
+                    lines.append(f'{metric}_total{{kind="{row["kind"]}",name="{row["name"]}"}} {float(row[field])}')
+        lines.append("# EOF")
+        with open(openmetrics_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+
+# shared by every module, so nothing has to thread a recorder through its call signatures
+metrics = Metrics()
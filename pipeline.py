@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import pandas as pd
+from artifact_store import ARTIFACT_DIR, apply_dtypes, load_artifact, save_artifact
+from metrics import metrics
+
+RUN_STATE_PATH = os.path.join(ARTIFACT_DIR, "run_state.json")
+
+def load_run_state(path=RUN_STATE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+def save_run_state(state, path=RUN_STATE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(state, file, indent=2)
+
+def _checkpoint_path(name):
+    return os.path.join(ARTIFACT_DIR, name, "checkpoint.jsonl")
+
+def append_checkpoint(name, df):
+    """
+    Append rows finished by a stage that is still running, so an interrupted run can pick up from them.
+    """
+    path = _checkpoint_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lines = df.to_json(orient="records", lines=True) if len(df) else ""
+    with open(path, "a") as file:
+        # older pandas versions leave off the final newline
+        file.write(lines if lines.endswith("\n") or not lines else lines + "\n")
+
+def load_checkpoint(name):
+    path = _checkpoint_path(name)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    return apply_dtypes(pd.read_json(path, orient="records", lines=True))
+
+def clear_checkpoint(name):
+    path = _checkpoint_path(name)
+    if os.path.exists(path):
+        os.remove(path)
+
+def required_stages(stages, selected):
+    """
+    The selected stages plus every stage they depend on, directly or indirectly.
+    """
+    needed = set()
+    pending = list(selected)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(stages[name][0])
+    return needed
+
+def dependent_stages(stages, name):
+    """
+    The stages that depend on name, directly or indirectly.
+    """
+    dependents = set()
+    changed = True
+    while changed:
+        changed = False
+        for stage, (dependencies, _) in stages.items():
+            if stage not in dependents and (name in dependencies or dependents & set(dependencies)):
+                dependents.add(stage)
+                changed = True
+    return dependents
+
+def run_pipeline(stages, selected, context, resume=False, max_parallel_stages=2):
+    """
+    Run the selected stages of a dependency graph, with independent stages running concurrently.
+
+    stages maps a stage name to (dependencies, function). A function is called with the shared context and a
+    dict of its dependencies' results, and returns a DataFrame that is checkpointed as an artifact of the same
+    name (or None). Dependencies that are not selected are loaded from their latest artifact, or from the CSV
+    written by earlier FKScout versions. With resume, stages already completed by the interrupted run are
+    loaded from the version that run saved.
+    """
+    state = load_run_state() if resume else None
+    if state is None:
+        state = {"run_id": time.strftime("%Y%m%dT%H%M%S"), "stages": sorted(selected), "completed": {}}
+    else:
+        print(f"Resuming run {state['run_id']}, completed stages: {', '.join(state['completed']) or 'none'}")
+    save_run_state(state)
+    state_lock = threading.Lock()
+
+    results = {}
+    needed = required_stages(stages, selected)
+    for name in needed:
+        if name in state["completed"]:
+            results[name] = load_artifact(name, state["completed"][name])
+        elif name not in selected:
+            results[name] = load_artifact(name, legacy_csv=f"files/{name}.csv")
+            if results[name] is None:
+                raise RuntimeError(f"Stage '{name}' has no saved results, add it to --stages")
+
+    def run_stage(name):
+        dependencies, function = stages[name]
+        print(f"Stage {name}: started")
+        with metrics.timer("stage", name):
+            result = function(context, {dependency: results[dependency] for dependency in dependencies})
+            if result is None:
+                version = None
+            else:
+                # a stage that streamed its result into the artifact store says so in attrs
+                version = result.attrs.get("artifact_version") or save_artifact(name, result, inputs=dependencies)
+        with state_lock:
+            state["completed"][name] = version
+            save_run_state(state)
+        print(f"Stage {name}: done")
+        return result
+
+    pending = {name for name in needed if name not in results}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_parallel_stages) as executor:
+        while pending or running:
+            ready = [name for name in pending if all(dependency in results for dependency in stages[name][0])]
+            for name in ready:
+                pending.discard(name)
+                running[executor.submit(run_stage, name)] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                # a failed stage stops the run, its finished siblings stay checkpointed for --resume
+                results[name] = future.result()
+    return results
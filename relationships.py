@@ -0,0 +1,68 @@
+import pandas as pd
+from heuristics import dataset_of
+
+def add_key_ratios(validation):
+    """
+    Add the uniqueness ratio of every candidate and the share of valid references of every foreign key.
+    """
+    validation = validation.copy()
+    records = validation['records'].astype(float)
+    valid = validation['valid_references'].astype(float)
+    total = valid + validation['invalid_references'].astype(float)
+    validation['uniqueness_ratio'] = (validation['unique_records'].astype(float) / records).where(records > 0)
+    validation['valid_ratio'] = (valid / total).where(total > 0)
+    return validation
+
+def connected_components(edges):
+    """
+    Number the groups of tables linked by edges, largest group first.
+    Returns a Series mapping every table in edges to its component.
+    """
+    parent = {}
+
+    def find(table):
+        root = parent.setdefault(table, table)
+        while root != parent[root]:
+            root = parent[root]
+        while table != root:
+            parent[table], table = root, parent[table]
+        return root
+
+    for child, referenced in zip(edges['table_name'], edges['referenced_table']):
+        parent[find(child)] = find(referenced)
+    roots = pd.Series({table: find(table) for table in list(parent)}, dtype=object)
+    # a stable sort keeps first-seen order among equal sizes, so numbering is the same between runs
+    sizes = roots.value_counts(sort=False).sort_values(ascending=False, kind="stable")
+    numbering = pd.Series(range(len(sizes)), index=sizes.index)
+    return roots.map(numbering)
+
+def find_relationships(validation, threshold):
+    """
+    The validated foreign keys that exist and have more than threshold valid references, one row per
+    (table, column, referenced table, referenced column), with their ratios and connected component.
+    """
+    validation = add_key_ratios(validation)
+    relationships = validation[
+        (validation['key_type'] == 'foreign')
+        & (validation['exists'] == 1)
+        & (validation['valid_ratio'] > threshold)
+    ].drop_duplicates(['table_name', 'column_name', 'referenced_table', 'referenced_column'])
+    relationships = relationships[[
+        'table_name', 'column_name', 'referenced_table', 'referenced_column', 'uniqueness_ratio', 'valid_ratio'
+    ]].reset_index(drop=True)
+    relationships['component'] = relationships['table_name'].map(connected_components(relationships))
+    return relationships
+
+def partition_relationships(relationships, partition="none"):
+    """
+    Split relationships into separately rendered groups: everything at once, one group per connected
+    component, or one per dataset (the subject area of a project-wide run, by the referencing table).
+    Returns a list of (group name, relationships).
+    """
+    if partition == "none" or relationships.empty:
+        return [("all", relationships)]
+    if partition == "component":
+        keys = relationships['component']
+    else:
+        keys = relationships['table_name'].map(dataset_of).fillna("default")
+    return [(str(key), group) for key, group in relationships.groupby(keys, sort=True)]
@@ -0,0 +1,53 @@
+import pandas as pd
+
+# a composite key is written as one column_name, its columns joined by KEY_SEPARATOR, e.g. order_id,line_number
+KEY_SEPARATOR = ","
+
+def key_columns(column_name):
+    return str(column_name).split(KEY_SEPARATOR)
+
+def is_composite(column_name):
+    return KEY_SEPARATOR in str(column_name)
+
+def existence_key(candidates):
+    """
+    The (table, column) Series whose existence decides each candidate's: primary keys are looked up on their own
+    table, foreign keys on the referenced table.
+    """
+    primary = candidates['key_type'] == 'primary'
+    return (candidates['table_name'].where(primary, candidates.get('referenced_table')),
+            candidates['column_name'].where(primary, candidates.get('referenced_column')))
+
+class SchemaCatalog:
+    """
+    In-memory index of the columns returned by extract_schema, so existence checks need no query.
+    """
+    def __init__(self, schema_df):
+        self.columns = set(zip(schema_df['table_name'], schema_df['column_name']))
+        self.index = pd.MultiIndex.from_tuples(list(self.columns), names=['table_name', 'column_name'])
+
+    def exists(self, table, column):
+        return all((table, part) in self.columns for part in key_columns(column))
+
+    def exists_mask(self, tables, columns):
+        """
+        exists for whole columns at once: a bool Series telling which (table, column) pairs are in the schema.
+        """
+        pairs = pd.MultiIndex.from_arrays([tables.astype(object), columns.astype(object)])
+        mask = pd.Series(pairs.isin(self.index), index=tables.index, dtype=bool)
+        # composite keys exist when every one of their columns does
+        composite = columns.astype(object).map(is_composite, na_action='ignore').fillna(False).astype(bool)
+        if composite.any():
+            mask[composite] = [self.exists(table, column) for table, column in zip(tables[composite], columns[composite])]
+        return mask
+
+    def key_exists_mask(self, candidates):
+        # whether the key of every candidate exists, as located by existence_key
+        return self.exists_mask(*existence_key(candidates))
+
+    def filter_existing(self, candidates):
+        """
+        Keep the candidates whose own column and referenced column (for foreign keys) both exist.
+        """
+        mask = self.exists_mask(candidates['table_name'], candidates['column_name']) & self.key_exists_mask(candidates)
+        return candidates[mask]
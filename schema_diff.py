@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import pandas as pd
+from bigquery_client import fetch_dataframe
+
+SNAPSHOT_PATH = "files/schema_snapshot.json"
+
+def fetch_last_modified(client, project_id, dataset, qualify=False):
+    # __TABLES__ is a metadata view, so this query is not billed by bytes scanned
+    query = f"""
+    SELECT
+        table_id,
+        last_modified_time
+    FROM
+        `{project_id}.{dataset}.__TABLES__`
+    """
+    result = fetch_dataframe(client, query)
+    prefix = f"{dataset}." if qualify else ""
+    return {
+        f"{prefix}{table}": int(modified)
+        for table, modified in zip(result['table_id'], result['last_modified_time'])
+    }
+
+def build_snapshot(schema_df, last_modified):
+    """
+    Fingerprint each table by its ordered column list (and types, when known) plus its last modification time.
+    """
+    columns = ['column_name', 'data_type'] if 'data_type' in schema_df else ['column_name']
+    snapshot = {}
+    for table, table_df in schema_df.groupby('table_name', sort=False):
+        payload = table_df[columns].to_csv(index=False)
+        snapshot[table] = {
+            "columns": hashlib.sha256(payload.encode("utf-8")).hexdigest(),
+            "last_modified_time": last_modified.get(table),
+        }
+    return snapshot
+
+def load_snapshot(path=SNAPSHOT_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def save_snapshot(snapshot, path=SNAPSHOT_PATH):
+    with open(path, "w") as file:
+        json.dump(snapshot, file, indent=2)
+
+def diff_snapshots(previous, current):
+    """
+    Returns the tables that were added or changed, and the tables that were removed.
+    """
+    changed = {table for table, fingerprint in current.items() if previous.get(table) != fingerprint}
+    removed = set(previous) - set(current)
+    return changed, removed
+
+def referencing_tables(candidates, tables):
+    """
+    Tables with a foreign key candidate pointing at any of the given tables.
+    """
+    if candidates is None or 'referenced_table' not in candidates:
+        return set()
+    return set(candidates.loc[candidates['referenced_table'].isin(tables), 'table_name'])
+
+def merge_previous(fresh, previous, stale_tables, removed_tables=()):
+    """
+    Combine freshly computed rows with the previous run's rows for every table that was not recomputed.
+    Previous rows of a removed table, or that reference one, are dropped.
+    """
+    if previous is None:
+        return fresh
+    keep = ~previous['table_name'].isin(stale_tables) & ~previous['table_name'].isin(removed_tables)
+    if 'referenced_table' in previous:
+        keep &= ~previous['referenced_table'].isin(removed_tables)
+    return pd.concat([previous[keep], fresh], ignore_index=True)
@@ -0,0 +1,413 @@
+"""
+The stages of an FKScout run and the state they share. The command line lives in FKScout.py, which imports this
+module only once its arguments are parsed.
+"""
+import threading
+import pandas as pd
+from symbolic_analysis import RateLimiter, find_fk_all_tables, find_pk_chunked
+from job_scheduler import run_jobs
+from cost_planner import BudgetExceeded, ByteBudget, plan_validation
+from schema_catalog import SchemaCatalog, existence_key
+from llm_cache import LLMCache
+from heuristics import infer_composite_foreign_keys, infer_foreign_keys, infer_primary_keys, tables_named_by
+from composite_keys import find_composite_keys, is_unique
+from inclusion_dependencies import discover_inclusion_dependencies
+from artifact_store import load_artifact
+from pipeline import append_checkpoint, clear_checkpoint, load_checkpoint
+from schema_diff import (
+    build_snapshot,
+    diff_snapshots,
+    fetch_last_modified,
+    load_snapshot,
+    merge_previous,
+    referencing_tables,
+)
+from domain_model_diagram import generate_mermaid_programmatically, print_mermaid
+from relationships import find_relationships, partition_relationships
+
+# share of valid references a foreign key needs to be drawn in the diagram
+VALID_REFERENCE_THRESHOLD = 0.1
+
+def _job_result(results, batch_key, item):
+    # a batched job covers every item, a per-candidate fallback job is keyed by batch_key + (item,)
+    for result in (results.get(batch_key), results.get(batch_key + (item,))):
+        if isinstance(result, dict):
+            return result.get(item)
+    return None
+
+def _align_results(found, keys, columns):
+    """
+    Line up per-key query results with the rows of keys (a DataFrame of key columns) with a single reindex.
+    found maps a key tuple to a result tuple, which may be shorter than columns; missing results become NaN.
+    """
+    frame = pd.DataFrame(
+        [key + tuple(result) + (None,) * (len(columns) - len(result)) for key, result in found.items() if result],
+        columns=list(keys.columns) + columns,
+    ).set_index(list(keys.columns))
+    return frame.reindex(pd.MultiIndex.from_frame(keys.astype(object))).astype(float)
+
+def validate_keys(warehouse, candidates, max_concurrent_jobs=8, catalog=None,
+                  validation_mode="exact", sample_percent=10, job_config=None):
+    approx = validation_mode == "approx"
+    if catalog is not None:
+        # existence is answered from the local schema index, and missing columns are never queried
+        exists = catalog.key_exists_mask(candidates).astype(int)
+        queryable = catalog.filter_existing(candidates)
+        existence_keys = []
+    else:
+        queryable = candidates
+        existence_keys = list(dict.fromkeys(zip(*existence_key(candidates))))
+
+    uniqueness_columns = {
+        table: list(dict.fromkeys(group['column_name']))
+        for table, group in queryable.groupby('table_name')
+    }
+    foreign_keys = queryable[queryable['key_type'] == 'foreign']
+    references = {
+        table: list(dict.fromkeys(zip(group['column_name'], group['referenced_table'], group['referenced_column'])))
+        for table, group in foreign_keys.groupby('table_name')
+    }
+
+    # one uniqueness scan per table, one existence lookup per key and one join query per child table
+    jobs = [
+        (('uniqueness', table), warehouse.check_uniqueness, (table, columns, approx, job_config))
+        for table, columns in uniqueness_columns.items()
+    ]
+    jobs += [
+        (('exists', table, column), warehouse.key_exists, (table, column, job_config))
+        for table, column in existence_keys
+    ]
+    jobs += [
+        (('references', table), warehouse.check_references, (table, refs, sample_percent if approx else None, job_config))
+        for table, refs in references.items()
+    ]
+    print(f"Running {len(jobs)} validation queries, {max_concurrent_jobs} at a time")
+    results = run_jobs(jobs, max_concurrent_jobs)
+
+    # a single bad column fails the whole batch, so rerun failed batches one candidate at a time;
+    # a batch over the byte budget is not retried, the smaller queries would only spend what is left of it
+    def failed(result):
+        return isinstance(result, Exception) and not isinstance(result, BudgetExceeded)
+
+    fallback_jobs = []
+    for table, columns in uniqueness_columns.items():
+        if failed(results[('uniqueness', table)]):
+            fallback_jobs += [
+                (('uniqueness', table, column), warehouse.check_uniqueness, (table, [column], False, job_config))
+                for column in columns
+            ]
+    for table, refs in references.items():
+        if failed(results[('references', table)]):
+            fallback_jobs += [
+                (('references', table, reference), warehouse.check_references, (table, [reference], None, job_config))
+                for reference in refs
+            ]
+    if fallback_jobs:
+        print(f"Retrying {len(fallback_jobs)} candidates individually")
+        results.update(run_jobs(fallback_jobs, max_concurrent_jobs))
+
+    if approx:
+        # escalate to an exact join only where the confidence interval straddles the threshold
+        escalate = {}
+        for table, refs in references.items():
+            for reference in refs:
+                estimate = _job_result(results, ('references', table), reference)
+                if estimate and len(estimate) == 4 and estimate[2] <= VALID_REFERENCE_THRESHOLD <= estimate[3]:
+                    escalate.setdefault(table, []).append(reference)
+        if escalate:
+            print(f"Escalating {sum(map(len, escalate.values()))} borderline references to exact queries")
+            results.update(run_jobs([
+                (('references_exact', table), warehouse.check_references, (table, refs, None, job_config))
+                for table, refs in escalate.items()
+            ], max_concurrent_jobs))
+
+    # collect one result per distinct key, then line them up with every candidate row in one reindex
+    counts = {
+        (table, column): _job_result(results, ('uniqueness', table), column)
+        for table, columns in uniqueness_columns.items() for column in columns
+    }
+    counts = _align_results(counts, candidates[['table_name', 'column_name']],
+                            ['records', 'unique_records', 'unique_records_margin'])
+    candidates['records'] = counts['records'].to_numpy()
+    candidates['unique_records'] = counts['unique_records'].to_numpy()
+
+    if catalog is None:
+        existence = {key: results.get(('exists',) + key) for key in existence_keys}
+        existence = {key: (value,) for key, value in existence.items() if not isinstance(value, Exception)}
+        table, column = existence_key(candidates)
+        exists = _align_results(existence, pd.DataFrame({'table': table, 'column': column}), ['exists'])['exists']
+    candidates['exists'] = exists.to_numpy()
+
+    reference_results = {
+        (table,) + reference: _job_result(results, ('references_exact', table), reference)
+        or _job_result(results, ('references', table), reference)
+        for table, refs in references.items() for reference in refs
+    }
+    reference_results = _align_results(
+        # primary key candidates may come without the referenced columns at all
+        reference_results, candidates.reindex(columns=['table_name', 'column_name', 'referenced_table', 'referenced_column']),
+        ['valid_references', 'invalid_references', 'valid_ratio_lower', 'valid_ratio_upper']
+    )
+    candidates['valid_references'] = reference_results['valid_references'].to_numpy()
+    candidates['invalid_references'] = reference_results['invalid_references'].to_numpy()
+    if approx:
+        candidates['unique_records_margin'] = counts['unique_records_margin'].to_numpy()
+        candidates['valid_ratio_lower'] = reference_results['valid_ratio_lower'].to_numpy()
+        candidates['valid_ratio_upper'] = reference_results['valid_ratio_upper'].to_numpy()
+    return candidates
+
+def analysis_scope(context, schema_df):
+    """
+    Tables to (re)analyze: every table, or in incremental mode only those that changed since the last run.
+    Returns (changed, removed, affected), where affected adds the tables referencing changed or removed ones.
+    """
+    with context['lock']:
+        if 'changed' not in context:
+            if context['args'].incremental:
+                dataset = context['dataset']
+                datasets = [dataset] if dataset else sorted({table.split(".")[0] for table in schema_df['table_name']})
+                last_modified = {}
+                for dataset_id in datasets:
+                    last_modified.update(fetch_last_modified(context['client'], context['project_id'], dataset_id, qualify=not dataset))
+                context['snapshot'] = build_snapshot(schema_df, last_modified)
+                changed, removed = diff_snapshots(load_snapshot(), context['snapshot'])
+                print(f"{len(changed)} tables added or changed and {len(removed)} removed since the last run")
+                previous = load_artifact("fk_analysis", legacy_csv="files/fk_analysis.csv",
+                                         columns=['table_name', 'referenced_table'])
+                # unchanged tables may point at a new table that no earlier candidate could reference
+                affected = changed | referencing_tables(previous, changed | removed) | tables_named_by(schema_df, changed)
+            else:
+                changed = affected = set(schema_df['table_name'])
+                removed = set()
+            context['changed'], context['removed'], context['affected'] = changed, removed, affected
+        return context['changed'], context['removed'], context['affected']
+
+def apply_byte_budget(context, candidates, catalog):
+    """
+    With --max_bytes, dry-run the validation queries and keep the candidates that fit in what is left of the budget.
+    Returns (candidates to validate, pruned candidates, the ByteBudget to pass as the job config of their queries).
+    """
+    args = context['args']
+    budget = context['byte_budget']
+    if budget is None:
+        return candidates, candidates.iloc[0:0], None
+    with context['lock']:
+        kept, pruned, plan = plan_validation(
+            budget, context['project_id'], context['dataset'], candidates, catalog,
+            args.validation_mode, args.sample_percent, args.max_concurrent_jobs, context['warehouse'].dialect
+        )
+    if len(pruned):
+        print(f"Skipping {len(pruned)} candidates that do not fit in --max_bytes")
+    return kept, pruned, budget
+
+def stage_schema(context, inputs):
+    if context['dataset']:
+        print("Fetching dataset schema...")
+    return context['warehouse'].extract_schema()
+
+def stage_pk_analysis(context, inputs):
+    args = context['args']
+    schema_df = inputs['schema']
+    changed, removed, _ = analysis_scope(context, schema_df)
+    print('Searching for primary keys')
+    pk_scope = schema_df[schema_df['table_name'].isin(changed)]
+    heuristic_keys, unresolved = infer_primary_keys(pk_scope) if args.heuristics else (None, pk_scope)
+    pk_analysis_output = find_pk_chunked(
+        unresolved[['table_name', 'column_name']], context['llm_cache'], context['rate_limiter'],
+        args.pk_token_budget, args.llm_concurrency
+    )
+    primary_keys = pd.DataFrame(pk_analysis_output["arguments"]["keys"])
+    if heuristic_keys is not None:
+        print(f"{len(heuristic_keys)} primary keys resolved by naming rules")
+        primary_keys = pd.concat([heuristic_keys, primary_keys], ignore_index=True)
+    if args.incremental:
+        previous = load_artifact("pk_analysis", legacy_csv="files/pk_analysis.csv")
+        primary_keys = merge_previous(primary_keys, previous, changed | removed)
+    return primary_keys
+
+def stage_pk_validation(context, inputs):
+    args = context['args']
+    schema_df = inputs['schema']
+    changed, removed, _ = analysis_scope(context, schema_df)
+    primary_keys = inputs['pk_analysis']
+    print("Checking primary key uniqueness")
+    candidates = primary_keys[
+        (primary_keys['key_type'] == 'primary') & primary_keys['table_name'].isin(changed)
+    ][['table_name', 'column_name', 'key_type']].copy()
+    catalog = SchemaCatalog(schema_df)
+    candidates, pruned, job_config = apply_byte_budget(context, candidates, catalog)
+    pk_validation = validate_keys(
+        context['warehouse'], candidates.copy(), args.max_concurrent_jobs,
+        catalog, args.validation_mode, args.sample_percent, job_config
+    )
+    pk_validation = pd.concat([pk_validation, pruned], ignore_index=True)
+    if args.incremental:
+        pk_validation = merge_previous(pk_validation, load_artifact("pk_validation"), changed | removed)
+    return pk_validation
+
+def stage_composite_keys(context, inputs):
+    args = context['args']
+    columns = ['table_name', 'column_name', 'key_type', 'records', 'unique_records', 'exists']
+    if not args.composite_keys:
+        return pd.DataFrame(columns=columns)
+    schema_df = inputs['schema']
+    pk_validation = inputs['pk_validation']
+    changed, removed, _ = analysis_scope(context, schema_df)
+    # tables with a validated single-column key need no composite one
+    # approximate counts are unique within their margin of error, as composite keys are judged
+    counts = pk_validation.reindex(columns=['records', 'unique_records', 'unique_records_margin'])
+    counts = counts.dropna(subset=['records', 'unique_records']).fillna({'unique_records_margin': 0})
+    keyed = {
+        table for table, count in zip(pk_validation.loc[counts.index, 'table_name'], counts.itertuples(index=False))
+        if is_unique(tuple(count))
+    }
+    tables = [table for table in dict.fromkeys(schema_df['table_name']) if table in changed and table not in keyed]
+    print(f"Searching for composite keys in {len(tables)} tables without a unique column")
+    composite_keys = find_composite_keys(
+        context['warehouse'], schema_df, tables, args.max_concurrent_jobs, args.max_key_columns,
+        args.validation_mode == "approx", context['byte_budget']
+    )
+    print(f"{len(composite_keys)} composite keys found")
+    if args.incremental:
+        composite_keys = merge_previous(composite_keys, load_artifact("composite_keys"), changed | removed)
+    return composite_keys
+
+def stage_fk_analysis(context, inputs):
+    args = context['args']
+    schema_df = inputs['schema']
+    primary_keys = inputs['pk_analysis']
+    _, removed, affected = analysis_scope(context, schema_df)
+    print('Searching for foreign keys')
+    fk_scope = schema_df[schema_df['table_name'].isin(affected)]
+    if args.heuristics:
+        heuristic_keys, ambiguous = infer_foreign_keys(fk_scope, primary_keys)
+        print(f"{len(heuristic_keys)} foreign keys resolved by naming rules, {len(ambiguous)} ambiguous columns left for GPT-4")
+    else:
+        heuristic_keys, ambiguous = None, fk_scope
+    candidates = find_fk_all_tables(
+        ambiguous, primary_keys, context['llm_cache'], args.llm_concurrency, context['rate_limiter']
+    )
+    candidates['inferred_by'] = 'llm'
+    if heuristic_keys is not None:
+        heuristic_keys['inferred_by'] = 'heuristic'
+        candidates = pd.concat([heuristic_keys, candidates], ignore_index=True)
+    if args.discover_from_data:
+        print('Searching for foreign keys in the column values')
+        # every table can be a parent, only the affected ones are scored as children
+        discovered = discover_inclusion_dependencies(
+            context['client'], context['project_id'], context['dataset'], schema_df, args.max_concurrent_jobs,
+            child_tables=affected, job_config=context['byte_budget']
+        )
+        discovered['inferred_by'] = 'data'
+        candidates = pd.concat([candidates, discovered], ignore_index=True).drop_duplicates(
+            subset=['table_name', 'column_name', 'referenced_table', 'referenced_column']
+        )
+    candidates = candidates[candidates['column_name']!="id"]
+    if args.incremental:
+        previous = load_artifact("fk_analysis", legacy_csv="files/fk_analysis.csv")
+        candidates = merge_previous(candidates, previous, affected, removed)
+    print(f"LLM cache: {context['llm_cache'].stats()}")
+    return candidates
+
+def stage_schema_validation(context, inputs):
+    args = context['args']
+    schema_df = inputs['schema']
+    candidates = inputs['fk_analysis']
+    composite_keys = inputs['composite_keys']
+    if len(composite_keys):
+        composite_candidates = infer_composite_foreign_keys(schema_df, composite_keys)
+        composite_candidates['inferred_by'] = 'heuristic'
+        print(f"{len(composite_candidates)} composite foreign key candidates")
+        candidates = pd.concat([candidates, composite_candidates], ignore_index=True)
+    _, removed, affected = analysis_scope(context, schema_df)
+    print("Validating the keys")
+    filtered_candidates = candidates[
+        candidates['referenced_table'].notnull() & 
+        candidates['referenced_column'].notnull() &
+        candidates['table_name'].isin(affected)
+    ]
+
+    # validate a few child tables at a time and checkpoint each finished group
+    validated = []
+    if args.resume:
+        checkpoint = load_checkpoint("schema_validation")
+        if checkpoint is not None:
+            print(f"Resuming validation with {len(checkpoint)} checkpointed candidates")
+            validated.append(checkpoint)
+            filtered_candidates = filtered_candidates[~filtered_candidates['table_name'].isin(checkpoint['table_name'])]
+    else:
+        clear_checkpoint("schema_validation")
+    catalog = SchemaCatalog(schema_df)
+    filtered_candidates, pruned, job_config = apply_byte_budget(context, filtered_candidates, catalog)
+    tables = list(dict.fromkeys(filtered_candidates['table_name']))
+    for start in range(0, len(tables), args.max_concurrent_jobs):
+        group = filtered_candidates[filtered_candidates['table_name'].isin(tables[start:start + args.max_concurrent_jobs])].copy()
+        group = validate_keys(
+            context['warehouse'], group, args.max_concurrent_jobs, catalog,
+            args.validation_mode, args.sample_percent, job_config
+        )
+        append_checkpoint("schema_validation", group)
+        validated.append(group)
+    if not validated:
+        # nothing to validate, but the result still needs the validation columns
+        validated.append(validate_keys(
+            context['warehouse'], filtered_candidates.copy(),
+            args.max_concurrent_jobs, catalog, args.validation_mode, args.sample_percent, job_config
+        ))
+    # candidates over the byte budget are kept, unvalidated
+    validated.append(pruned)
+    schema_validation = pd.concat(validated, ignore_index=True)
+
+    if args.incremental:
+        previous = load_artifact("schema_validation", legacy_csv="files/schema_validation.csv")
+        schema_validation = merge_previous(schema_validation, previous, affected, removed)
+    clear_checkpoint("schema_validation")
+    return schema_validation
+
+def stage_relationships(context, inputs):
+    return find_relationships(inputs['schema_validation'], VALID_REFERENCE_THRESHOLD)
+
+def stage_render(context, inputs):
+    relationships = inputs['relationships']
+    name = context['dataset'] or context['project_id']
+    partition = context['args'].diagram_partition
+    groups = partition_relationships(relationships, partition)
+    for group, group_relationships in groups:
+        mermaid_html = print_mermaid(generate_mermaid_programmatically(group_relationships))
+        path = f"files/{name}_mermaid_chart.html" if partition == "none" else f"files/{name}_mermaid_chart_{group}.html"
+        with open(path, "w") as file:
+            file.write(mermaid_html)
+    if partition == "none":
+        print(f"Mermaid chart saved to 'files/{name}_mermaid_chart.html'.")
+    else:
+        print(f"{len(groups)} Mermaid charts saved to 'files/{name}_mermaid_chart_<{partition}>.html'.")
+    return None
+
+# stage name -> (stages it depends on, function); stage outputs are saved as artifacts of the same name
+STAGES = {
+    "schema": ([], stage_schema),
+    "pk_analysis": (["schema"], stage_pk_analysis),
+    "pk_validation": (["schema", "pk_analysis"], stage_pk_validation),
+    "fk_analysis": (["schema", "pk_analysis"], stage_fk_analysis),
+    "composite_keys": (["schema", "pk_validation"], stage_composite_keys),
+    "schema_validation": (["schema", "fk_analysis", "composite_keys"], stage_schema_validation),
+    "relationships": (["schema_validation"], stage_relationships),
+    "render": (["relationships"], stage_render),
+}
+
+def build_context(args, warehouse):
+    """
+    The state shared by every stage of a run.
+    """
+    return {
+        'args': args,
+        'warehouse': warehouse,
+        'client': warehouse.client,
+        'project_id': warehouse.project_id,
+        # without --dataset, tables are named dataset.table so keys can be found across datasets
+        'dataset': warehouse.dataset,
+        'llm_cache': LLMCache(args.llm_cache, args.llm_cache_ttl_days * 24 * 3600, args.llm_cache_max_entries),
+        'rate_limiter': RateLimiter(args.llm_rpm, args.llm_tpm),
+        'byte_budget': ByteBudget(warehouse.client, args.max_bytes) if args.max_bytes else None,
+        'lock': threading.Lock(),
+    }
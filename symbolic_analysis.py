@@ -1,29 +1,272 @@
 import os
-from openai import OpenAI
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 import pandas as pd
 import json
+from metrics import metrics
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 
-# Initialize the OpenAI client
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
-def find_pk(schema_df):
-    schema_string = schema_df.to_csv(index=False)
-    messages = [
-        {
-            "role": "system",
-            "content": "You are an AI assistant specializing in database schema analysis."
-        },
-        {
-            "role": "user",
-            "content": (
-                "Identify all potential primary keys in the following database schema. "
-                "Provide the results in JSON format.\n\n"
-                f"{schema_string}\n\n"
-            ),
-        },
-    ]
+# the OpenAI client, created by get_client on the first request
+client = None
+client_lock = threading.Lock()
+
+MODEL = "gpt-4"
+# bump whenever the prompts or function schemas below change, so cached answers are not reused
+PROMPT_VERSION = 1
+MAX_TOKENS = 1000
+
+class RateLimiter:
+    """
+    Token buckets for the requests-per-minute and tokens-per-minute limits of the OpenAI API.
+    """
+    def __init__(self, requests_per_minute=500, tokens_per_minute=30000):
+        self.rates = {"requests": requests_per_minute / 60, "tokens": tokens_per_minute / 60}
+        self.capacity = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.available = dict(self.capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        # a single request larger than the bucket is let through once the bucket is full
+        needed = {"requests": 1, "tokens": min(tokens, self.capacity["tokens"])}
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                for bucket, rate in self.rates.items():
+                    self.available[bucket] = min(
+                        self.capacity[bucket], self.available[bucket] + (now - self.updated_at) * rate
+                    )
+                self.updated_at = now
+                wait = max(
+                    (needed[bucket] - self.available[bucket]) / self.rates[bucket] for bucket in needed
+                )
+                if wait <= 0:
+                    for bucket in needed:
+                        self.available[bucket] -= needed[bucket]
+                    return
+            time.sleep(wait)
+
+def count_tokens(text):
+    # exact with tiktoken, otherwise roughly four characters per token
+    if tiktoken is not None:
+        return len(tiktoken.encoding_for_model(MODEL).encode(text))
+    return len(text) // 4 + 1
+
+def estimate_tokens(messages, functions):
+    # prompt plus the completion budget
+    return count_tokens(json.dumps(messages)) + count_tokens(json.dumps(functions)) + MAX_TOKENS
+
+def get_client():
+    """
+    The shared OpenAI client. The SDK takes most of a second to import, so it is only loaded by runs that ask GPT-4.
+    """
+    global client
+    with client_lock:
+        if client is None:
+            with metrics.timer("import", "openai"):
+                from openai import OpenAI
+            client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        return client
+
+def create_completion(messages, functions, rate_limiter=None, max_retries=5, backoff=2.0, stream=False):
+    client = get_client()
+    import openai
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire(estimate_tokens(messages, functions))
+        try:
+            start = time.perf_counter()
+            request = dict(
+                model=MODEL,
+                messages=messages,
+                functions=functions,  # Use the functions parameter
+                function_call="auto",  # Automatically call the function if applicable
+                max_tokens=MAX_TOKENS,
+            )
+            if stream:
+                # the chunks are read, and the usage recorded, by stream_function_call
+                return client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+            response = client.chat.completions.create(**request)
+            metrics.record_completion(functions[0]["name"], response, time.perf_counter() - start)
+            return response
+        except (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError) as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff * 2 ** attempt + random.uniform(0, backoff)
+            print(f"OpenAI request failed, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+class KeyStreamParser:
+    """
+    Incremental parser of function-call arguments shaped like {"keys": [{...}, {...}]}.
+    Each key object is decoded as soon as its closing brace arrives, so a cut-off answer keeps its complete keys.
+    """
+    def __init__(self):
+        self.text = ""
+        self.position = 0
+        self.in_array = False
+        self.in_string = False
+        self.escaped = False
+        self.depth = 0
+        self.start = None
+        self.keys = []
+
+    def feed(self, fragment):
+        """
+        Add a fragment of the arguments; returns the key objects it completed.
+        """
+        self.text += fragment
+        completed = []
+        for self.position in range(self.position, len(self.text)):
+            char = self.text[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif not self.in_array:
+                self.in_array = char == "["
+            elif char == "{":
+                if self.depth == 0:
+                    self.start = self.position
+                self.depth += 1
+            elif char == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        completed.append(json.loads(self.text[self.start:self.position + 1]))
+                    except json.JSONDecodeError:
+                        pass
+        self.position = len(self.text)
+        self.keys += completed
+        return completed
+
+def stream_function_call(messages, functions, rate_limiter=None):
+    """
+    Stream a function-call completion and parse the key objects out of its arguments as they arrive.
+    Returns (function name, complete keys, finish reason); the reason is "length" when the answer was cut off at
+    MAX_TOKENS and "interrupted" when the stream broke off.
+    """
+    import httpx
+    import openai
+    start = time.perf_counter()
+    stream = create_completion(messages, functions, rate_limiter, stream=True)
+    parser = KeyStreamParser()
+    name = finish_reason = usage = first_key_seconds = None
+    try:
+        for chunk in stream:
+            # with include_usage, the last chunk carries the usage and no choices
+            usage = getattr(chunk, "usage", None) or usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            function_call = getattr(choice.delta, "function_call", None)
+            if function_call is not None:
+                name = function_call.name or name
+                if function_call.arguments and parser.feed(function_call.arguments) and first_key_seconds is None:
+                    first_key_seconds = time.perf_counter() - start
+            finish_reason = choice.finish_reason or finish_reason
+    except (openai.APIError, httpx.HTTPError) as e:
+        print(f"OpenAI stream broke off after {len(parser.keys)} keys: {e}")
+        finish_reason = "interrupted"
+    metrics.record_completion(
+        functions[0]["name"], SimpleNamespace(usage=usage), time.perf_counter() - start,
+        first_key_seconds=first_key_seconds or 0.0,
+    )
+    return name, parser.keys, finish_reason
+
+def _key_position(rows, key):
+    # the position in rows of the column a key is about, or None if the model named a column it was not sent
+    match = rows['column_name'] == key.get('column_name')
+    if 'table_name' in rows and key.get('table_name'):
+        match &= rows['table_name'] == key['table_name']
+    positions = match.to_numpy().nonzero()[0]
+    return positions[-1] if len(positions) else None
+
+def infer_keys(rows, build_messages, functions, rate_limiter=None):
+    """
+    Ask for the keys among the schema rows with a streamed function call.
+    When an answer is cut off, its complete keys are kept and only the columns after the last of them are asked
+    for again; if not a single key came through, the rows are asked for in two halves instead. Every follow-up
+    covers fewer rows, so this ends once all rows are answered or a single column keeps getting cut off.
+    Returns (function name, keys, truncated), with a None name if the model answered without calling the function
+    and truncated set when some columns were never answered.
+    """
+    name = None
+    keys = []
+    truncated = False
+    pending = [rows]
+    while pending:
+        part = pending.pop(0)
+        part_name, part_keys, finish_reason = stream_function_call(build_messages(part), functions, rate_limiter)
+        name = name or part_name
+        keys += part_keys
+        if finish_reason not in ("length", "interrupted"):
+            continue
+        positions = [position for position in (_key_position(part, key) for key in part_keys) if position is not None]
+        if positions:
+            remaining = [part.iloc[max(positions) + 1:]]
+        elif len(part) > 1:
+            remaining = [part.iloc[:len(part) // 2], part.iloc[len(part) // 2:]]
+        else:
+            truncated = True
+            remaining = []
+        remaining = [rest for rest in remaining if len(rest)]
+        if remaining:
+            print(f"Answer cut off after {len(part_keys)} keys, asking again for "
+                  f"{sum(map(len, remaining))} remaining columns")
+        pending = remaining + pending
+    if truncated:
+        print(f"Warning: the answer stayed cut off, {len(keys)} keys found but some columns were not covered")
+    return name, keys, truncated
+
+def find_pk(schema_df, cache=None, rate_limiter=None):
+    """
+    Ask for the primary keys of every table in schema_df with one prompt.
+    Answers are cached per table, so only the tables whose columns changed are sent again.
+    """
+    cached_keys = []
+    cache_keys = {}
+    if cache is not None:
+        for table, table_df in schema_df.groupby('table_name', sort=False):
+            cache_key = cache.make_key("find_pk", MODEL, PROMPT_VERSION, table_df.to_csv(index=False))
+            cached = cache.get(cache_key)
+            if cached is not None:
+                cached_keys += cached["arguments"]["keys"]
+            else:
+                cache_keys[table] = cache_key
+        schema_df = schema_df[schema_df['table_name'].isin(cache_keys)]
+        if schema_df.empty:
+            return {"name": "validate_keys", "arguments": {"keys": cached_keys}}
+
+    def build_messages(rows):
+        return [
+            {
+                "role": "system",
+                "content": "You are an AI assistant specializing in database schema analysis."
+            },
+            {
+                "role": "user",
+                "content": (
+                    "Identify all potential primary keys in the following database schema. "
+                    "Provide the results in JSON format.\n\n"
+                    f"{rows.to_csv(index=False)}\n\n"
+                ),
+            },
+        ]
 
     # Define the function schema
     functions = [
@@ -55,64 +298,105 @@ def find_pk(schema_df):
         }
     ]
 
-    # Make the API call
+    # Stream the API call, so a cut-off answer keeps its complete keys
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            functions=functions,  # Use the functions parameter
-            function_call="auto",  # Automatically call the function if applicable
-            max_tokens=1000,
-        )
-        
-        # Extract function call details
-        if response.choices[0].message.function_call:
-            function_call = response.choices[0].message.function_call
-            function_name = function_call.name
-            function_arguments = json.loads(function_call.arguments)  # Parse the arguments JSON
-
-            print(f"Function Name: {function_name}")
-            print(f"Function Arguments: {function_arguments}")
-
-            # Process arguments (example logic)
-            return {
-                "name": function_name,
-                "arguments": function_arguments,
-            }
-        else:
+        function_name, keys, truncated = infer_keys(schema_df, build_messages, functions, rate_limiter)
+        if function_name is None:
             print("No function call detected.")
-            return None
+            # the tables answered from the cache still have their keys
+            return {"name": "validate_keys", "arguments": {"keys": cached_keys}}
+
+        arguments = {"keys": keys}
+        print(f"Function Name: {function_name}")
+        print(f"Function Arguments: {arguments}")
+        # one entry per table, holding the keys the answer gave for it (possibly none);
+        # an incomplete answer is not cached, so the next run asks again
+        if not truncated:
+            for table, cache_key in cache_keys.items():
+                table_keys = [key for key in keys if key.get("table_name") == table]
+                cache.put(cache_key, {"name": function_name, "arguments": {"keys": table_keys}})
+        return {"name": function_name, "arguments": {"keys": cached_keys + keys}}
 
     except Exception as e:
         print(f"Error: {e}")
-        return None
+        return {"name": "validate_keys", "arguments": {"keys": cached_keys}}
 
 
-def find_fk(table_data, primary_keys):
+def plan_pk_batches(schema_df, token_budget=3000):
+    """
+    Pack whole tables into batches whose schema CSV stays under token_budget tokens.
+    A table that alone exceeds the budget gets a batch of its own.
+    """
+    header_tokens = count_tokens(",".join(schema_df.columns) + "\n")
+    batches = []
+    batch = []
+    batch_tokens = header_tokens
+    for table, table_df in schema_df.groupby('table_name', sort=False):
+        table_tokens = count_tokens(table_df.to_csv(index=False, header=False))
+        if batch and batch_tokens + table_tokens > token_budget:
+            batches.append(pd.concat(batch, ignore_index=True))
+            batch = []
+            batch_tokens = header_tokens
+        batch.append(table_df)
+        batch_tokens += table_tokens
+    if batch:
+        batches.append(pd.concat(batch, ignore_index=True))
+    return batches
+
+def find_pk_chunked(schema_df, cache=None, rate_limiter=None, token_budget=3000, max_workers=8):
+    """
+    Run find_pk over token-budgeted batches of tables and merge the key lists into one find_pk style result.
+    """
+    batches = plan_pk_batches(schema_df, token_budget)
+    print(f"Searching for primary keys in {len(batches)} batches")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda batch: find_pk(batch, cache, rate_limiter), batches))
+
+    keys = []
+    seen = set()
+    for result in results:
+        if result is None:
+            continue
+        for key in result["arguments"].get("keys", []):
+            identity = (key.get("table_name"), key.get("column_name"), key.get("key_type"))
+            if identity not in seen:
+                seen.add(identity)
+                keys.append(key)
+    return {"name": "validate_keys", "arguments": {"keys": keys}}
+
+def find_fk(table_data, primary_keys, cache=None, rate_limiter=None):
     """
     Use OpenAI's API to analyze column names for patterns.
     """
     # Convert the DataFrame to a CSV string
     table_data_csv = table_data.to_csv(index=False)
     primary_keys_csv = primary_keys.to_csv(index=False)
+    if cache is not None:
+        # the reference keys are a set, so their order must not change the cache key
+        reference_keys = primary_keys.sort_values(list(primary_keys.columns)).to_csv(index=False)
+        cache_key = cache.make_key("find_fk", MODEL, PROMPT_VERSION, table_data_csv, reference_keys)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
 
     # Define the messages
-    messages = [
-        {
-            "role": "system",
-            "content": "You are an AI assistant specializing in database schema analysis."
-        },
-        {
-            "role": "user",
-            "content": (
-                "Identify all potential foreign keys in the following database table:"
-                f"{table_data_csv}\n\n"
-                "Please ise list of tables with primary keys provided below as a reference:"
-                f"{primary_keys_csv}\n\n"
-                "Provide the results in JSON format.\n\n"
-            ),
-        },
-    ]
+    def build_messages(rows):
+        return [
+            {
+                "role": "system",
+                "content": "You are an AI assistant specializing in database schema analysis."
+            },
+            {
+                "role": "user",
+                "content": (
+                    "Identify all potential foreign keys in the following database table:"
+                    f"{rows.to_csv(index=False)}\n\n"
+                    "Please ise list of tables with primary keys provided below as a reference:"
+                    f"{primary_keys_csv}\n\n"
+                    "Provide the results in JSON format.\n\n"
+                ),
+            },
+        ]
 
     # Define the function schema
     functions = [
@@ -154,38 +438,50 @@ def find_fk(table_data, primary_keys):
         },
     ]
 
-    # Make the API call
+    # Stream the API call, so a cut-off answer keeps its complete keys
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            functions=functions,  # Use the functions parameter
-            function_call="auto",  # Automatically call the function if applicable
-            max_tokens=1000,
-        )
-        
-        # Extract function call details
-        if response.choices[0].message.function_call:
-            function_call = response.choices[0].message.function_call
-            function_name = function_call.name
-            function_arguments = json.loads(function_call.arguments)  # Parse the arguments JSON
-
-            print(f"Function Name: {function_name}")
-            print(f"Function Arguments: {function_arguments}")
-
-            # Process arguments (example logic)
-            return {
-                "name": function_name,
-                "arguments": function_arguments,
-            }
-        else:
+        function_name, keys, truncated = infer_keys(table_data, build_messages, functions, rate_limiter)
+        if function_name is None:
             print("No function call detected.")
             return None
 
+        result = {
+            "name": function_name,
+            "arguments": {"keys": keys},
+        }
+        print(f"Function Name: {function_name}")
+        print(f"Function Arguments: {result['arguments']}")
+        # an incomplete answer is not cached, so the next run asks again
+        if cache is not None and not truncated:
+            cache.put(cache_key, result)
+        return result
+
     except Exception as e:
         print(f"Error: {e}")
         return None
 
+def find_fk_all_tables(schema_df, primary_keys, cache=None, max_workers=8, rate_limiter=None):
+    """
+    Run find_fk for every table concurrently and combine the foreign key candidates once at the end.
+    """
+    tables = list(dict.fromkeys(schema_df['table_name']))
+
+    def analyze(table):
+        table_data = schema_df[schema_df['table_name'] == table][['table_name', 'column_name']]
+        fk_analysis_output = find_fk(table_data, primary_keys, cache, rate_limiter)
+        if fk_analysis_output is None or "keys" not in fk_analysis_output.get("arguments", {}):
+            return None
+        foreign_keys = pd.DataFrame(fk_analysis_output["arguments"]["keys"])
+        foreign_keys['table_name'] = table
+        return foreign_keys
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(analyze, tables))
+    results = [foreign_keys for foreign_keys in results if foreign_keys is not None]
+    if not results:
+        return pd.DataFrame(columns=['table_name', 'column_name', 'key_type', 'referenced_table', 'referenced_column'])
+    return pd.concat(results, ignore_index=True)
+
 # Example usage
 if __name__ == "__main__":
     schema_df = pd.read_csv("schema.csv")
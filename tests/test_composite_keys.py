@@ -0,0 +1,32 @@
+import duckdb
+from composite_keys import find_composite_keys, is_unique, lattice_level
+from warehouse import DuckDBWarehouse
+
+def test_is_unique_allows_the_margin_of_approximate_counts():
+    assert is_unique((100, 100))
+    assert not is_unique((100, 97))
+    assert is_unique((100, 97, 5.0))
+    assert not is_unique((100, 90, 5.0))
+    assert not is_unique((0, 0))
+
+def test_lattice_level_skips_supersets_of_unique_keys():
+    distinct = {'a': 10, 'b': 10, 'c': 10}
+    assert lattice_level(['a', 'b', 'c'], 2, [{'a', 'b'}], distinct, 50) == [('a', 'c'), ('b', 'c')]
+    assert lattice_level(['a', 'b', 'c'], 3, [{'a', 'b'}], distinct, 50) == []
+
+def test_lattice_level_skips_combinations_with_too_few_distinct_values():
+    distinct = {'a': 2, 'b': 3, 'c': 100}
+    # 2 * 3 distinct pairs cannot cover 50 rows
+    assert lattice_level(['a', 'b', 'c'], 2, [], distinct, 50) == [('a', 'c'), ('b', 'c')]
+
+def test_find_composite_keys_on_duckdb():
+    con = duckdb.connect()
+    con.execute("""
+        CREATE TABLE order_lines AS
+        SELECT range // 4 AS order_id, range % 4 AS line_no, range % 2 AS status FROM range(400)
+    """)
+    warehouse = DuckDBWarehouse(con)
+    schema_df = warehouse.extract_schema()
+    for approx in (False, True):
+        keys = find_composite_keys(warehouse, schema_df, ['order_lines'], approx=approx)
+        assert list(keys['column_name']) == ['order_id,line_no']
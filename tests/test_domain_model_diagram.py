@@ -0,0 +1,15 @@
+import pandas as pd
+from domain_model_diagram import generate_mermaid_programmatically
+
+def test_dataset_qualified_tables_get_safe_entity_names():
+    df = pd.DataFrame({
+        'table_name': ['sales.orders'],
+        'column_name': ['customer_id'],
+        'referenced_table': ['crm.customers'],
+    })
+    assert generate_mermaid_programmatically(df).splitlines() == [
+        'erDiagram',
+        'sales_orders["sales.orders"]',
+        'crm_customers["crm.customers"]',
+        'sales_orders }o--|| crm_customers : "customer_id"',
+    ]
@@ -0,0 +1,20 @@
+import pandas as pd
+from heuristics import infer_foreign_keys, tables_named_by
+
+def test_tables_named_by_finds_unchanged_tables_pointing_at_a_new_table():
+    schema_df = pd.DataFrame({
+        'table_name': ['orders', 'orders', 'invoices', 'customers'],
+        'column_name': ['id', 'customer_id', 'order_id', 'id'],
+    })
+    assert tables_named_by(schema_df, {'customers'}) == {'orders'}
+
+def test_infer_foreign_keys_leaves_unresolved_key_typed_columns_for_the_llm():
+    schema_df = pd.DataFrame({
+        'table_name': ['users', 'orders', 'orders', 'orders', 'orders'],
+        'column_name': ['id', 'id', 'user_id', 'created_by', 'amount'],
+        'data_type': ['INT64', 'INT64', 'INT64', 'INT64', 'FLOAT64'],
+    })
+    primary_keys = pd.DataFrame({'table_name': ['users', 'orders'], 'column_name': ['id', 'id']})
+    foreign_keys, ambiguous = infer_foreign_keys(schema_df, primary_keys)
+    assert list(zip(foreign_keys['column_name'], foreign_keys['referenced_table'])) == [('user_id', 'users')]
+    assert list(ambiguous['column_name']) == ['created_by']
@@ -0,0 +1,32 @@
+import random
+from inclusion_dependencies import estimate_containment
+
+def sketch(values, sketch_size):
+    # (total_rows, distinct_values, smallest hashes), as compute_column_sketches returns it
+    hashes = sorted(set(values))
+    return len(values), len(hashes), hashes[:sketch_size]
+
+def test_containment_is_exact_when_the_parent_sketch_holds_every_value():
+    parent = sketch(range(100), 256)
+    child = sketch(list(range(50)) + list(range(1000, 1050)), 256)
+    assert estimate_containment(child, parent, 256) == (0.5, 100)
+
+def test_containment_samples_child_values_below_the_largest_parent_hash():
+    # the parent sketch keeps 0..9, so only child values up to 9 can be judged
+    parent = sketch(range(0, 100), 10)
+    child = sketch([1, 3, 5, 7, 9, 11, 13, 150, 151, 152], 10)
+    assert estimate_containment(child, parent, 10) == (1.0, 5)
+
+def test_containment_of_disjoint_sets_is_zero():
+    assert estimate_containment(sketch(range(10, 20), 256), sketch(range(10), 256), 256) == (0.0, 10)
+    assert estimate_containment(sketch(range(200, 210), 10), sketch(range(100), 10), 10) == (0.0, 0)
+
+def test_containment_estimate_is_close_on_large_sets():
+    # hashes are uniform, so random integers stand in for them; 70% of the child values are in the parent
+    rng = random.Random(0)
+    values = rng.sample(range(10 ** 12), 40000)
+    parent_values, other_values = values[:30000], values[30000:]
+    child_values = rng.sample(parent_values, 7000) + other_values[:3000]
+    containment, sample_size = estimate_containment(sketch(child_values, 256), sketch(parent_values, 256), 256)
+    assert sample_size > 20
+    assert abs(containment - 0.7) < 0.15
@@ -0,0 +1,19 @@
+import pandas as pd
+from schema_diff import merge_previous
+
+def test_merge_previous_drops_rows_of_removed_tables():
+    previous = pd.DataFrame({
+        'table_name': ['dropped_tbl', 'orders', 'orders'],
+        'column_name': ['customer_id', 'customer_id', 'dropped_id'],
+        'referenced_table': ['customers', 'customers', 'dropped_tbl'],
+        'referenced_column': ['id', 'id', 'id'],
+    })
+    fresh = previous.iloc[0:0]
+    merged = merge_previous(fresh, previous, stale_tables=set(), removed_tables={'dropped_tbl'})
+    assert list(zip(merged['table_name'], merged['column_name'])) == [('orders', 'customer_id')]
+
+def test_merge_previous_replaces_stale_tables():
+    previous = pd.DataFrame({'table_name': ['orders', 'customers'], 'column_name': ['id', 'id']})
+    fresh = pd.DataFrame({'table_name': ['orders'], 'column_name': ['order_id']})
+    merged = merge_previous(fresh, previous, stale_tables={'orders'})
+    assert sorted(zip(merged['table_name'], merged['column_name'])) == [('customers', 'id'), ('orders', 'order_id')]
@@ -0,0 +1,65 @@
+import pandas as pd
+import pytest
+import symbolic_analysis
+from benchmark import FakeLLM
+from llm_cache import LLMCache
+from symbolic_analysis import KeyStreamParser, find_pk, infer_keys
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    llm = FakeLLM(latency=0, jitter=0)
+    prompts = []
+    create = llm.create
+
+    def recording_create(**kwargs):
+        prompts.append(FakeLLM.read_csv(kwargs["messages"][-1]["content"]))
+        return create(**kwargs)
+
+    llm.chat.completions.create = recording_create
+    monkeypatch.setattr(symbolic_analysis, "client", llm)
+    return prompts
+
+def schema(tables):
+    return pd.DataFrame({
+        'table_name': [table for table in tables for _ in range(2)],
+        'column_name': ['id', 'name'] * len(tables),
+    })
+
+def test_parser_ignores_quotes_and_braces_inside_strings():
+    parser = KeyStreamParser()
+    assert parser.feed('{"keys": [{"column_name": "a\\"}{", "note": "[{"}, {"column_name": "b"}]}') == [
+        {"column_name": 'a"}{', "note": "[{"},
+        {"column_name": "b"},
+    ]
+
+def test_parser_completes_keys_split_across_fragments():
+    parser = KeyStreamParser()
+    assert parser.feed('{"ke') == []
+    assert parser.feed('ys": [{"column_name": "a", "nested": {"x"') == []
+    assert parser.feed(': 1}}, {"column_name"') == [{"column_name": "a", "nested": {"x": 1}}]
+    assert parser.feed(': "b"}, {"colu') == [{"column_name": "b"}]
+    assert parser.keys == [{"column_name": "a", "nested": {"x": 1}}, {"column_name": "b"}]
+
+def test_cut_off_answer_is_followed_up_with_the_remaining_rows_only(fake_llm, monkeypatch):
+    # about two keys fit in an answer
+    monkeypatch.setattr(symbolic_analysis, "MAX_TOKENS", 40)
+    rows = schema([f"t{i}" for i in range(5)])
+    result = find_pk(rows)
+    assert sorted(key["table_name"] for key in result["arguments"]["keys"]) == [f"t{i}" for i in range(5)]
+    assert len(fake_llm) > 1
+    for previous, prompt in zip(fake_llm, fake_llm[1:]):
+        # every follow-up asks for the rows after the last key answered, and never again for those before
+        assert len(prompt) < len(previous)
+        assert list(prompt['table_name']) == list(rows['table_name'].iloc[-len(prompt):])
+
+def test_truncated_answer_is_not_cached(fake_llm, monkeypatch, tmp_path):
+    # not even one key fits in an answer, so the last column is never covered
+    monkeypatch.setattr(symbolic_analysis, "MAX_TOKENS", 5)
+    def build_messages(rows):
+        return [{"role": "user", "content": rows.to_csv(index=False)}]
+
+    _, _, truncated = infer_keys(schema(["t0"]), build_messages, [{"name": "validate_keys"}])
+    assert truncated
+    cache = LLMCache(str(tmp_path / "cache.sqlite"))
+    find_pk(schema(["t0"]), cache)
+    assert cache.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 0
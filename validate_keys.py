@@ -1,48 +1,209 @@
-from google.cloud import bigquery
+import math
 import pandas as pd
+from bigquery_client import fetch_row
+from schema_catalog import key_columns
 
-def check_pk_uniqueness(client, project_id, dataset, table, primary_key):
-    # Construct the query dynamically
-    query = f"""
-    SELECT
-        COUNT(*) AS total_rows,
-        COUNT(DISTINCT {primary_key}) AS unique_rows
-    FROM `{project_id}.{dataset}.{table}`;
+def table_ref(project_id, dataset, table):
+    # project-wide schemas qualify table names with their dataset, e.g. sales.orders
+    if "." in table:
+        return f"`{project_id}.{table}`"
+    return f"`{project_id}.{dataset}.{table}`"
+
+# relative standard error of APPROX_COUNT_DISTINCT (HLL++ at BigQuery's default precision of 15)
+APPROX_COUNT_DISTINCT_ERROR = 1.04 / math.sqrt(2 ** 15)
+# z-score of the reported confidence bounds (95%)
+CONFIDENCE_Z = 1.96
+
+class BigQueryDialect:
+    """
+    The SQL the batched query builders below need that differs between warehouses.
+    """
+    approx_distinct_error = APPROX_COUNT_DISTINCT_ERROR
+
+    def quote(self, name):
+        return f"`{name}`"
+
+    def table_ref(self, project_id, dataset, table):
+        return table_ref(project_id, dataset, table)
+
+    def columns_ref(self, project_id, dataset):
+        return f"`{project_id}.{dataset}.INFORMATION_SCHEMA.COLUMNS`"
+
+    def struct_key(self, parts):
+        return f"TO_JSON_STRING(STRUCT({', '.join(parts)}))"
+
+    def sample(self, percent):
+        return f" TABLESAMPLE SYSTEM ({percent} PERCENT)"
+
+class DuckDBDialect(BigQueryDialect):
+    """
+    DuckDB SQL, where a dataset is a schema of the database and the project is not part of table names.
     """
-    # Run the query
-    query_job = client.query(query)
-    result = query_job.result().to_dataframe()
-    total_rows = result.loc[0, "total_rows"]
-    unique_rows = result.loc[0, "unique_rows"]
-    return total_rows, unique_rows
+    # DuckDB's approx_count_distinct keeps 64 HyperLogLog registers, hence about 13% relative error
+    approx_distinct_error = 1.04 / math.sqrt(64)
+
+    def quote(self, name):
+        return f'"{name}"'
+
+    def table_ref(self, project_id, dataset, table):
+        if "." in table:
+            dataset, table = table.split(".", 1)
+        return f'"{dataset}"."{table}"'
+
+    def columns_ref(self, project_id, dataset):
+        return f"(SELECT * FROM information_schema.columns WHERE table_schema = '{dataset}')"
 
-def key_existence_check(client, project_id, dataset, table, key):
+    def struct_key(self, parts):
+        return f"to_json(row({', '.join(parts)}))"
+
+    def sample(self, percent):
+        # row-level sampling; DuckDB's system sampling picks whole vectors of 2048 rows
+        return f" TABLESAMPLE {percent}% (bernoulli)"
+
+BIGQUERY = BigQueryDialect()
+DUCKDB = DuckDBDialect()
+
+def key_existence_check(client, project_id, dataset, table, key, job_config=None, dialect=BIGQUERY):
+    if "." in table:
+        dataset, table = table.split(".", 1)
+    # 1 when every column of the (possibly composite) key exists
+    columns = key_columns(key)
+    names = ", ".join(f"'{column}'" for column in columns)
     query = f"""
-    SELECT COUNT(*) as records
-    FROM `{project_id}.{dataset}.INFORMATION_SCHEMA.COLUMNS`
-    WHERE table_name = '{table}' AND column_name = '{key}';
+    SELECT CASE WHEN COUNT(DISTINCT column_name) = {len(columns)} THEN 1 ELSE 0 END as records
+    FROM {dialect.columns_ref(project_id, dataset)}
+    WHERE table_name = '{table}' AND column_name IN ({names});
     """
 
-    query_job = client.query(query)
-    result = query_job.result().to_dataframe()
-    records = result.loc[0, "records"]
+    row = fetch_row(client, query, job_config)
+    records = row["records"]
     return records
 
-def verify_foreign_key(client, project_id, dataset, child_table, foreign_key, parent_table, primary_key):
-    query = f"""
+def wilson_interval(successes, trials, z=CONFIDENCE_Z):
+    """
+    Confidence interval for a proportion estimated from a sample.
+    """
+    if trials == 0:
+        return 0.0, 1.0
+    p = successes / trials
+    denominator = 1 + z ** 2 / trials
+    centre = (p + z ** 2 / (2 * trials)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / trials + z ** 2 / (4 * trials ** 2)) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+def key_expression(column, alias=None, dialect=BIGQUERY):
+    """
+    SQL for the value of a key: the column itself, or a JSON string of the struct of a composite key's columns.
+    """
+    prefix = f"{alias}." if alias else ""
+    parts = [f"{prefix}{dialect.quote(part)}" for part in key_columns(column)]
+    if len(parts) == 1:
+        return parts[0]
+    return dialect.struct_key(parts)
+
+def pk_uniqueness_batch_query(project_id, dataset, table, columns, approx=False, dialect=BIGQUERY):
+    distinct = "APPROX_COUNT_DISTINCT({})" if approx else "COUNT(DISTINCT {})"
+    distinct_counts = ",\n        ".join(
+        f"{distinct.format(key_expression(column, dialect=dialect))} AS unique_rows_{i}"
+        for i, column in enumerate(columns)
+    )
+    return f"""
     SELECT
-        SUM(CASE WHEN parent.{primary_key} IS NOT NULL THEN 1 ELSE 0 END) AS valid_references,
-        SUM(CASE WHEN parent.{primary_key} IS NULL THEN 1 ELSE 0 END) AS invalid_references
-    FROM `{project_id}.{dataset}.{child_table}` AS child
-    LEFT JOIN `{project_id}.{dataset}.{parent_table}` AS parent
-    ON child.{foreign_key} = parent.{primary_key};
-    """
-    query_job = client.query(query)
-    result = query_job.result().to_dataframe()
-    valid_references = result.loc[0, "valid_references"]
-    invalid_references = result.loc[0, "invalid_references"]
-
-    return valid_references, invalid_references
+        COUNT(*) AS total_rows,
+        {distinct_counts}
+    FROM {dialect.table_ref(project_id, dataset, table)};
+    """
+
+def foreign_keys_batch_query(project_id, dataset, child_table, references, sample_percent=None, dialect=BIGQUERY):
+    # parent keys are deduplicated before joining so several joins cannot fan out the child rows
+    counts = []
+    joins = []
+    for i, (foreign_key, parent_table, primary_key) in enumerate(references):
+        # composite keys join on every column pair; the first parent column tells whether a match was found
+        foreign_columns, primary_columns = key_columns(foreign_key), key_columns(primary_key)
+        matched = f"parent_{i}.{dialect.quote(primary_columns[0])}"
+        counts.append(
+            f"SUM(CASE WHEN {matched} IS NOT NULL THEN 1 ELSE 0 END) AS valid_references_{i},\n"
+            f"        SUM(CASE WHEN {matched} IS NULL THEN 1 ELSE 0 END) AS invalid_references_{i}"
+        )
+        distinct = ", ".join(dialect.quote(column) for column in primary_columns)
+        condition = " AND ".join(
+            f"child.{dialect.quote(foreign_column)} = parent_{i}.{dialect.quote(primary_column)}"
+            for foreign_column, primary_column in zip(foreign_columns, primary_columns)
+        )
+        joins.append(
+            f"LEFT JOIN (SELECT DISTINCT {distinct} FROM {dialect.table_ref(project_id, dataset, parent_table)}) AS parent_{i}\n"
+            f"    ON {condition}"
+        )
+    counts = ",\n        ".join(counts)
+    joins = "\n    ".join(joins)
+    sample = dialect.sample(sample_percent) if sample_percent else ""
+    return f"""
+    SELECT
+        {counts}
+    FROM {dialect.table_ref(project_id, dataset, child_table)} AS child{sample}
+    {joins};
+    """
+
+def check_pk_uniqueness_batch(client, project_id, dataset, table, columns, job_config=None, dialect=BIGQUERY):
+    """
+    Count total and distinct values for several key candidates of one table in a single scan.
+    Returns a dict mapping each column to (total_rows, unique_rows).
+    """
+    query = pk_uniqueness_batch_query(project_id, dataset, table, columns, dialect=dialect)
+    row = fetch_row(client, query, job_config)
+    total_rows = row["total_rows"]
+    return {
+        column: (total_rows, row[f"unique_rows_{i}"])
+        for i, column in enumerate(columns)
+    }
+
+def check_pk_uniqueness_approx_batch(client, project_id, dataset, table, columns, job_config=None, dialect=BIGQUERY):
+    """
+    Like check_pk_uniqueness_batch, but with APPROX_COUNT_DISTINCT.
+    Returns a dict mapping each column to (total_rows, unique_rows, unique_rows_margin).
+    """
+    query = pk_uniqueness_batch_query(project_id, dataset, table, columns, approx=True, dialect=dialect)
+    row = fetch_row(client, query, job_config)
+    total_rows = row["total_rows"]
+    estimates = {}
+    for i, column in enumerate(columns):
+        unique_rows = row[f"unique_rows_{i}"]
+        estimates[column] = (total_rows, unique_rows, CONFIDENCE_Z * dialect.approx_distinct_error * unique_rows)
+    return estimates
+
+def verify_foreign_keys_batch(client, project_id, dataset, child_table, references, job_config=None, dialect=BIGQUERY):
+    """
+    Check every (foreign_key, parent_table, primary_key) reference of one child table in a single query.
+    Returns a dict mapping each reference to (valid_references, invalid_references).
+    """
+    query = foreign_keys_batch_query(project_id, dataset, child_table, references, dialect=dialect)
+    row = fetch_row(client, query, job_config)
+    return {
+        reference: (row[f"valid_references_{i}"], row[f"invalid_references_{i}"])
+        for i, reference in enumerate(references)
+    }
+
+def verify_foreign_keys_approx_batch(client, project_id, dataset, child_table, references, sample_percent=10,
+                                     job_config=None, dialect=BIGQUERY):
+    """
+    Estimate the references of one child table from a TABLESAMPLE of its rows.
+    Returns a dict mapping each reference to (valid_references, invalid_references, valid_ratio_lower,
+    valid_ratio_upper), with counts scaled up to the full table and the ratio bounds at 95% confidence.
+    """
+    query = foreign_keys_batch_query(project_id, dataset, child_table, references, sample_percent, dialect)
+    row = fetch_row(client, query, job_config)
+    scale = 100 / sample_percent
+    estimates = {}
+    for i, reference in enumerate(references):
+        valid = row[f"valid_references_{i}"]
+        invalid = row[f"invalid_references_{i}"]
+        # SUM over an empty sample is NULL
+        valid = 0 if pd.isna(valid) else int(valid)
+        invalid = 0 if pd.isna(invalid) else int(invalid)
+        lower, upper = wilson_interval(valid, valid + invalid)
+        estimates[reference] = (valid * scale, invalid * scale, lower, upper)
+    return estimates
 
 def valid_and_invalid_matches():
     return true
\ No newline at end of file
@@ -0,0 +1,272 @@
+import os
+import re
+import threading
+from abc import ABC, abstractmethod
+from types import SimpleNamespace
+import pandas as pd
+from artifact_store import apply_dtypes, load_artifact, stream_artifact
+from bigquery_client import fetch_dataframe
+from metrics import metrics
+from validate_keys import (
+    BIGQUERY,
+    DUCKDB,
+    check_pk_uniqueness_approx_batch,
+    check_pk_uniqueness_batch,
+    key_existence_check,
+    verify_foreign_keys_approx_batch,
+    verify_foreign_keys_batch,
+)
+
+def extract_schema(client, project_id, dataset_id):
+    # query to fetch table schema
+    query = f"""
+    SELECT
+        table_name,
+        column_name,
+        data_type,
+        is_nullable
+    FROM
+        `{project_id}.{dataset_id}.INFORMATION_SCHEMA.COLUMNS`
+    ORDER BY
+        table_name, ordinal_position
+    """
+
+    # execute the query
+    results = fetch_dataframe(client, query)
+
+    return results
+
+def extract_project_schema(client, project_id, region, page_size=10000):
+    """
+    Fetch the columns of every dataset in a region with a single INFORMATION_SCHEMA query.
+    Result pages are streamed into a new version of the schema artifact as they arrive, and the DataFrame records
+    that version in attrs, so the pipeline does not save it again. Table names are qualified as dataset.table.
+    """
+    query = f"""
+    SELECT
+        CONCAT(table_schema, '.', table_name) AS table_name,
+        column_name,
+        data_type,
+        is_nullable
+    FROM
+        `{project_id}.region-{region}.INFORMATION_SCHEMA.COLUMNS`
+    ORDER BY
+        table_schema, table_name, ordinal_position
+    """
+    query_job = client.query(query)
+    version = stream_artifact("schema", query_job.result(page_size=page_size).to_arrow_iterable())
+    if version is None:
+        return pd.DataFrame(columns=['table_name', 'column_name', 'data_type', 'is_nullable'])
+    schema_df = apply_dtypes(load_artifact("schema", version))
+    schema_df.attrs["artifact_version"] = version
+    return schema_df
+
+class Warehouse(ABC):
+    """
+    Where the schema is read from and the key candidates are checked.
+    Every check covers several candidates of one table, so a backend can answer them in one scan.
+    """
+    # BigQuery-only features (incremental snapshots, value sketches, dry runs) need a BigQuery client
+    client = None
+
+    def __init__(self, project_id, dataset=None):
+        self.project_id = project_id
+        self.dataset = dataset
+
+    @abstractmethod
+    def extract_schema(self):
+        """
+        The columns of every table, as a DataFrame with table_name, column_name, data_type and is_nullable.
+        """
+
+    @abstractmethod
+    def check_uniqueness(self, table, columns, approx=False, job_config=None):
+        """
+        Returns a dict mapping each column to (total_rows, unique_rows), plus the margin of error when approx.
+        """
+
+    @abstractmethod
+    def check_references(self, child_table, references, sample_percent=None, job_config=None):
+        """
+        Check (foreign_key, parent_table, primary_key) references, on a sample of the child rows if sample_percent.
+        Returns a dict mapping each reference to (valid_references, invalid_references), plus the bounds of the
+        valid ratio when sampled.
+        """
+
+    @abstractmethod
+    def key_exists(self, table, column, job_config=None):
+        """
+        1 when every column of the key exists in the table, 0 otherwise.
+        """
+
+class SavedResultsWarehouse(Warehouse):
+    """
+    The backend of runs whose stages only read saved results, e.g. a re-render: it connects to nothing, and any
+    query is an error.
+    """
+    def _refuse(self, *args, **kwargs):
+        raise RuntimeError("This run only uses saved results, add a stage that queries the warehouse to --stages")
+
+    extract_schema = check_uniqueness = check_references = key_exists = _refuse
+
+class SQLWarehouse(Warehouse):
+    """
+    Runs the checks as the batched queries of validate_keys, written in the dialect of the client's database.
+    """
+    dialect = BIGQUERY
+
+    def __init__(self, client, project_id, dataset=None):
+        super().__init__(project_id, dataset)
+        self.client = client
+
+    def check_uniqueness(self, table, columns, approx=False, job_config=None):
+        check = check_pk_uniqueness_approx_batch if approx else check_pk_uniqueness_batch
+        return check(self.client, self.project_id, self.dataset, table, columns, job_config, self.dialect)
+
+    def check_references(self, child_table, references, sample_percent=None, job_config=None):
+        if sample_percent:
+            return verify_foreign_keys_approx_batch(
+                self.client, self.project_id, self.dataset, child_table, references, sample_percent, job_config,
+                self.dialect
+            )
+        return verify_foreign_keys_batch(
+            self.client, self.project_id, self.dataset, child_table, references, job_config, self.dialect
+        )
+
+    def key_exists(self, table, column, job_config=None):
+        return key_existence_check(self.client, self.project_id, self.dataset, table, column, job_config, self.dialect)
+
+class BigQueryWarehouse(SQLWarehouse):
+    """
+    Runs every check as a BigQuery query; without a dataset, the schema of every dataset in region is mapped.
+    """
+    def __init__(self, client, project_id, dataset=None, region="us"):
+        super().__init__(client, project_id, dataset)
+        self.region = region
+
+    def extract_schema(self):
+        if self.dataset:
+            return extract_schema(self.client, self.project_id, self.dataset)
+        print(f"Fetching the schemas of every dataset in region-{self.region}...")
+        return extract_project_schema(self.client, self.project_id, self.region)
+
+class DuckDBClient:
+    """
+    Runs DuckDB queries through the client interface bigquery_client uses (query_and_wait, or query and result).
+    Each thread runs them on its own cursor.
+    """
+    def __init__(self, con):
+        self.con = con
+        self.local = threading.local()
+
+    def query_and_wait(self, query, job_config=None):
+        if not hasattr(self.local, "cursor"):
+            self.local.cursor = self.con.cursor()
+        result = self.local.cursor.execute(query)
+        table = result.to_arrow_table() if hasattr(result, "to_arrow_table") else result.fetch_arrow_table()
+        return DuckDBRows(table)
+
+    def query(self, query, job_config=None):
+        if job_config is not None and getattr(job_config, "dry_run", False):
+            # DuckDB has no cost estimate, and scanning local files costs nothing
+            return SimpleNamespace(total_bytes_processed=0)
+        rows = self.query_and_wait(query, job_config)
+        return SimpleNamespace(result=lambda **kwargs: rows, total_bytes_processed=0, cache_hit=False)
+
+class DuckDBRows:
+    # the row iterator returned by query_and_wait; rows are dicts, which is how fetch_row reads them
+    def __init__(self, table):
+        self.table = table
+        self.total_rows = table.num_rows
+
+    def __iter__(self):
+        return iter(self.table.to_pylist())
+
+    def to_arrow(self, **kwargs):
+        return self.table
+
+    def to_dataframe(self, **kwargs):
+        return self.table.to_pandas()
+
+    def to_arrow_iterable(self, **kwargs):
+        return iter(self.table.to_batches())
+
+    def result(self, **kwargs):
+        return self
+
+# file types table_files can load, with the DuckDB function that reads them
+DATA_FILE_READERS = {".parquet": "read_parquet", ".csv": "read_csv_auto", ".csv.gz": "read_csv_auto"}
+
+def _data_file_reader(name):
+    return next((reader for suffix, reader in DATA_FILE_READERS.items() if name.endswith(suffix)), None)
+
+def table_files(data_dir):
+    """
+    The tables of an export directory: each <table>.parquet or <table>.csv file is a table, and so is each
+    <table>/ directory of Parquet or CSV parts (what BigQuery EXPORT DATA writes).
+    Returns a dict mapping each table name to (reader, file pattern).
+    """
+    tables = {}
+    for entry in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, entry)
+        if os.path.isdir(path):
+            parts = [name for name in os.listdir(path) if _data_file_reader(name)]
+            if parts:
+                suffix = next(suffix for suffix in DATA_FILE_READERS if parts[0].endswith(suffix))
+                tables[entry] = (_data_file_reader(parts[0]), os.path.join(path, f"*{suffix}"))
+        elif _data_file_reader(entry):
+            suffix = next(suffix for suffix in DATA_FILE_READERS if entry.endswith(suffix))
+            tables[entry[:-len(suffix)]] = (_data_file_reader(entry), path)
+    return tables
+
+class DuckDBWarehouse(SQLWarehouse):
+    """
+    Runs the checks with DuckDB on the local cores, against tables in one schema of a DuckDB database.
+    """
+    dialect = DUCKDB
+
+    def __init__(self, con, dataset="main"):
+        super().__init__(DuckDBClient(con), "local", dataset)
+        self.con = con
+
+    def extract_schema(self):
+        query = f"""
+        SELECT
+            table_name,
+            column_name,
+            data_type,
+            is_nullable
+        FROM
+            information_schema.columns
+        WHERE
+            table_schema = '{self.dataset}'
+        ORDER BY
+            table_name, ordinal_position
+        """
+        return fetch_dataframe(self.client, query)
+
+    @staticmethod
+    def default_dataset(data_dir):
+        # the schema an export directory is exposed as, unless --dataset names one
+        return re.sub(r"\W", "_", os.path.basename(os.path.normpath(data_dir)))
+
+    @classmethod
+    def from_files(cls, data_dir, dataset=None):
+        """
+        Expose a directory of Parquet/CSV exports as views in a schema named after the directory.
+        The files are scanned by every query, nothing is loaded up front.
+        DuckDB is imported here rather than with the module, so BigQuery runs and re-renders do not load it.
+        """
+        with metrics.timer("import", "duckdb"):
+            try:
+                import duckdb
+            except ImportError:
+                raise RuntimeError("The DuckDB backend needs the duckdb package: pip install duckdb")
+        dataset = dataset or cls.default_dataset(data_dir)
+        con = duckdb.connect()
+        con.execute(f'CREATE SCHEMA IF NOT EXISTS "{dataset}"')
+        tables = table_files(data_dir)
+        for table, (reader, pattern) in tables.items():
+            con.execute(f"""CREATE VIEW "{dataset}"."{table}" AS SELECT * FROM {reader}('{pattern.replace("'", "''")}')""")
+        print(f"Found {len(tables)} tables in {data_dir}")
+        return cls(con, dataset)